@@ -16,13 +16,8 @@ def make_openai_client(
 
     return OpenAI(api_key=api_key)
 
-@retry(
-    reraise=True,
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=1, max=8),
-    retry=retry_if_exception_type((APIConnectionError, APIStatusError)),
-)
-def ask_gpt (user_text: str) -> str:
+def ask_gpt_once(user_text: str) -> str:
+    """Один запрос без повторов — повторами управляет вызывающий (см. llm_governor)."""
     HOST = os.getenv("PROXY_HOST")
     PORT = os.getenv("PROXY_PORT")
     USER = os.getenv("PROXY_USER")
@@ -62,6 +57,15 @@ def ask_gpt (user_text: str) -> str:
 
     return text
 
+@retry(
+    reraise=True,
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=1, max=8),
+    retry=retry_if_exception_type((APIConnectionError, APIStatusError)),
+)
+def ask_gpt (user_text: str) -> str:
+    return ask_gpt_once(user_text)
+
 def probe_openai() -> str:
     try:
         return ask_gpt("test")
@@ -0,0 +1,193 @@
+import hmac
+import json
+import base64
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy import select, func, tuple_
+from sqlalchemy.orm import Session
+from .db import Chat, ChatStats, Message
+
+MAX_LIMIT = 200
+
+
+def require_token(request: Request):
+    """
+    Доступ к /api только с токеном API_TOKEN (заголовок Authorization: Bearer <token>
+    или X-API-Token). Без настроенного токена API закрыт: сервер слушает 0.0.0.0 ради вебхука,
+    а здесь вся переписка с покупателями.
+    """
+    expected = request.app.state.api_token
+    if not expected:
+        raise HTTPException(status_code=403, detail="API_TOKEN is not configured")
+    auth = request.headers.get("authorization", "")
+    given = auth[7:] if auth.lower().startswith("bearer ") else request.headers.get("x-api-token", "")
+    if not hmac.compare_digest(given.encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="bad token")
+
+
+# Чтение сохраненной переписки. Все списки листаются курсором (keyset) по индексам,
+# без OFFSET, поэтому стоимость страницы не растет с глубиной пролистывания.
+router = APIRouter(prefix="/api", dependencies=[Depends(require_token)])
+
+
+def get_db(request: Request):
+    db: Session = request.app.state.session_factory()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def _encode_cursor(ts: datetime, key: str) -> str:
+    raw = json.dumps([ts.isoformat(), key]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts, key = json.loads(raw)
+        return datetime.fromisoformat(ts), str(key)
+    except Exception:
+        raise HTTPException(status_code=400, detail="bad cursor")
+
+
+def _message_out(m) -> Dict[str, Any]:
+    return {
+        "id": m.id,
+        "chat_id": m.chat_id,
+        "author_id": m.author_id,
+        "direction": m.direction,
+        "type": m.type,
+        "text": m.text,
+        "created_ts": m.created_ts.isoformat() if m.created_ts else None,
+        "is_read": m.is_read,
+    }
+
+
+def _page(rows: List[Any], limit: int, ts_attr: str, key_attr: str) -> Optional[str]:
+    """Курсор следующей страницы, если она есть (запрашиваем limit + 1 строку)."""
+    if len(rows) <= limit:
+        return None
+    last = rows[limit - 1]
+    return _encode_cursor(getattr(last, ts_attr), getattr(last, key_attr))
+
+
+_MESSAGE_COLUMNS = (
+    Message.id, Message.chat_id, Message.author_id, Message.direction,
+    Message.type, Message.text, Message.created_ts, Message.is_read,
+)
+
+
+@router.get("/rules")
+def routing_rules(request: Request):
+    """Загруженные правила маршрутизации и счетчики срабатываний."""
+    return request.app.state.routing.stats()
+
+
+@router.post("/rules/reload")
+def reload_routing_rules(request: Request):
+    if not request.app.state.routing.reload():
+        raise HTTPException(status_code=422, detail="rules not loaded, see logs")
+    return request.app.state.routing.stats()
+
+
+@router.get("/llm")
+def llm_stats(request: Request):
+    """Состояние ограничителя запросов к GPT: активные, в очереди, объединенные."""
+    return request.app.state.llm.stats()
+
+
+@router.get("/outbound")
+def outbound_stats(request: Request):
+    """Очередь ответов в Авито: чаты с неотправленными сообщениями и их число."""
+    queue = request.app.state.outbound
+    if queue is None:
+        raise HTTPException(status_code=404, detail="replies to Avito are disabled")
+    return queue.stats()
+
+
+@router.get("/chats")
+def list_chats(
+    limit: int = Query(50, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    unread_only: bool = False,
+    db: Session = Depends(get_db),
+):
+    """Чаты по времени последнего сообщения; счетчик непрочитанных берется из chat_stats."""
+    q = (
+        select(ChatStats.chat_id, ChatStats.unread_count, ChatStats.last_message_ts, Chat.ctx)
+        .join(Chat, Chat.id == ChatStats.chat_id)
+        .where(ChatStats.last_message_ts.is_not(None))
+    )
+    if unread_only:
+        q = q.where(ChatStats.unread_count > 0)
+    if cursor:
+        ts, chat_id = _decode_cursor(cursor)
+        q = q.where(tuple_(ChatStats.last_message_ts, ChatStats.chat_id) < tuple_(ts, chat_id))
+    rows = db.execute(
+        q.order_by(ChatStats.last_message_ts.desc(), ChatStats.chat_id.desc()).limit(limit + 1)
+    ).all()
+    return {
+        "chats": [
+            {
+                "chat_id": r.chat_id,
+                "unread_count": r.unread_count,
+                "last_message_ts": r.last_message_ts.isoformat(),
+                "meta": (r.ctx or {}).get("meta"),
+            }
+            for r in rows[:limit]
+        ],
+        "next_cursor": _page(rows, limit, "last_message_ts", "chat_id"),
+    }
+
+
+@router.get("/chats/{chat_id}/messages")
+def chat_history(
+    chat_id: str,
+    limit: int = Query(50, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """История чата от новых к старым; идет по индексу (chat_id, created_ts, id)."""
+    q = select(*_MESSAGE_COLUMNS).where(Message.chat_id == chat_id, Message.created_ts.is_not(None))
+    if cursor:
+        ts, mid = _decode_cursor(cursor)
+        q = q.where(tuple_(Message.created_ts, Message.id) < tuple_(ts, mid))
+    rows = db.execute(q.order_by(Message.created_ts.desc(), Message.id.desc()).limit(limit + 1)).all()
+    return {
+        "messages": [_message_out(r) for r in rows[:limit]],
+        "next_cursor": _page(rows, limit, "created_ts", "id"),
+    }
+
+
+@router.get("/search")
+def search_messages(
+    q: str = Query(..., min_length=1),
+    chat_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_LIMIT),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Полнотекстовый поиск (русская морфология, синтаксис websearch: "фраза", -слово, or).
+    Результаты упорядочены по времени, а не по релевантности. План выбирает Postgres:
+    для редкого слова — bitmap-скан GIN-индекса и сортировка совпадений; для частого —
+    обратный проход по ix_messages_created (или ix_messages_chat_created с chat_id)
+    с проверкой text_tsv, который останавливается на limit + 1 строке. Худший случай —
+    слово средней частоты без chat_id: сортируются все совпадения, задержка растет с их
+    числом; гарантированного p99 на больших объемах этот запрос не дает.
+    """
+    tsq = func.websearch_to_tsquery("russian", q)
+    stmt = select(*_MESSAGE_COLUMNS).where(Message.text_tsv.op("@@")(tsq), Message.created_ts.is_not(None))
+    if chat_id:
+        stmt = stmt.where(Message.chat_id == chat_id)
+    if cursor:
+        ts, mid = _decode_cursor(cursor)
+        stmt = stmt.where(tuple_(Message.created_ts, Message.id) < tuple_(ts, mid))
+    rows = db.execute(stmt.order_by(Message.created_ts.desc(), Message.id.desc()).limit(limit + 1)).all()
+    return {
+        "messages": [_message_out(r) for r in rows[:limit]],
+        "next_cursor": _page(rows, limit, "created_ts", "id"),
+    }
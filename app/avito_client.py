@@ -1,29 +1,66 @@
 import time
+import threading
 import requests
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
+from .models import AvitoMessage, ChatItem, decode_chat, decode_chat_list, decode_messages
 
 logger = logging.getLogger(__name__)
 
+# ограничения API (swagger.json, параметры limit/offset): глубже 1000 + страница
+# ни список чатов, ни история чата не листаются
+MAX_PAGE_SIZE = 100
+MAX_OFFSET = 1000
+
+
+class RateLimiter:
+    """Общий для всех потоков лимит запросов в секунду (равномерный интервал между вызовами)."""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps if rps and rps > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_at)
+            self._next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
 class AvitoClient:
     BASE = "https://api.avito.ru"
     TIMEOUT = 30
 
-    def __init__(self, client_id: str, client_secret: str, user_id: str):
+    def __init__(self, client_id: str, client_secret: str, user_id: str, rps: float = 0):
         self.client_id = client_id
         self.client_secret = client_secret
         self.user_id = user_id
         self._token: Optional[str] = None
         self._token_expires_at: float = 0.0
+        self._token_lock = threading.Lock()
         self._r = requests.Session()
         self._r.trust_env = False
         self._nopx = {"http": None, "https": None}
+        self._limiter = RateLimiter(rps)
+        self._send_version: Optional[str] = None
 
     def _ensure_token(self):
         if self._token and time.time() < self._token_expires_at - 60:
             logger.debug("Токен еще действителен")
             return
-            
+
+        with self._token_lock:
+            # другой поток мог уже обновить токен, пока мы ждали блокировку
+            if self._token and time.time() < self._token_expires_at - 60:
+                return
+            self._fetch_token()
+
+    def _fetch_token(self):
         logger.info("Получение нового токена Авито")
         r = self._r.post(
             f"{self.BASE}/token",
@@ -47,9 +84,10 @@ class AvitoClient:
 
     def _headers(self) -> Dict[str, str]:
         self._ensure_token()
+        self._limiter.wait()
         return {"Authorization": f"Bearer {self._token}", "Accept": "application/json"}
 
-    def list_chats(self, limit: int = 100, offset: int = 0, unread_only: bool = False) -> Dict[str, Any]:
+    def list_chats(self, limit: int = 100, offset: int = 0, unread_only: bool = False) -> List[ChatItem]:
         params = {"limit": limit, "offset": offset}
         if unread_only:
             params["unread_only"] = "true"
@@ -60,11 +98,20 @@ class AvitoClient:
             headers=self._headers(), params=params, timeout=self.TIMEOUT, proxies=self._nopx
         )
         r.raise_for_status()
-        data = r.json()
-        logger.debug(f"Получено чатов: {len(data.get('chats', []))}")
-        return data
+        chats = decode_chat_list(r.content)
+        logger.debug(f"Получено чатов: {len(chats)}")
+        return chats
+
+    def get_chat(self, chat_id: str) -> ChatItem:
+        logger.debug(f"Запрос информации о чате {chat_id}")
+        r = self._r.get(
+            f"{self.BASE}/messenger/v2/accounts/{self.user_id}/chats/{chat_id}",
+            headers=self._headers(), timeout=self.TIMEOUT, proxies=self._nopx
+        )
+        r.raise_for_status()
+        return decode_chat(r.content)
 
-    def get_messages(self, chat_id: str, limit: int = 100, offset: int = 0) -> Dict[str, Any]:
+    def get_messages(self, chat_id: str, limit: int = 100, offset: int = 0) -> List[AvitoMessage]:
         params = {"limit": limit, "offset": offset}
         
         logger.debug(f"Запрос сообщений чата {chat_id}: {params}")
@@ -73,16 +120,23 @@ class AvitoClient:
             headers=self._headers(), params=params, timeout=self.TIMEOUT, proxies=self._nopx
         )
         r.raise_for_status()
-        data = r.json()
-        
-        # Определяем количество сообщений
-        if isinstance(data, list):
-            msg_count = len(data)
-        else:
-            msg_count = len(data.get("messages", []))
-        logger.debug(f"Получено сообщений из чата {chat_id}: {msg_count}")
-        
-        return data
+        msgs = decode_messages(r.content)
+        logger.debug(f"Получено сообщений из чата {chat_id}: {len(msgs)}")
+        return msgs
+
+    def get_voice_files(self, voice_ids: List[str], batch_size: int = 50) -> Dict[str, str]:
+        """Ссылки на файлы голосовых сообщений (действуют час); ids запрашиваются пачками."""
+        urls: Dict[str, str] = {}
+        for i in range(0, len(voice_ids), batch_size):
+            batch = voice_ids[i:i + batch_size]
+            logger.debug(f"Запрос ссылок на голосовые: {len(batch)} шт.")
+            r = self._r.get(
+                f"{self.BASE}/messenger/v1/accounts/{self.user_id}/getVoiceFiles",
+                headers=self._headers(), params={"voice_ids": batch}, timeout=self.TIMEOUT, proxies=self._nopx
+            )
+            r.raise_for_status()
+            urls.update((r.json() or {}).get("voices_urls") or {})
+        return urls
 
     def chat_read(self, chat_id: str) -> None:
         r = self._r.post(
@@ -94,17 +148,47 @@ class AvitoClient:
     def send_text(self, chat_id: str, text: str) -> Dict[str, Any]:
         headers = self._headers() | {"Content-Type": "application/json"}
         body = {"message": {"text": text}, "type": "text"}
-        url_v1 = f"{self.BASE}/messenger/v1/accounts/{self.user_id}/chats/{chat_id}/messages"
-        url_v2 = f"{self.BASE}/messenger/v2/accounts/{self.user_id}/chats/{chat_id}/messages"
-        
+        # рабочую версию API запоминаем после первой удачной отправки, чтобы не тратить
+        # лишний запрос на каждый ответ; если она перестала отвечать — пробуем заново
+        versions = [self._send_version] if self._send_version else ["v1", "v2"]
+
         logger.info(f"Отправка сообщения в чат {chat_id}: {text[:50]}...")
-        r = self._r.post(url_v1, headers=headers, json=body, timeout=self.TIMEOUT, proxies=self._nopx)
-        if r.status_code in (404, 405):
-            logger.debug(f"Попытка через v2 API для чата {chat_id}")
-            r = self._r.post(url_v2, headers=headers, json=body, timeout=self.TIMEOUT, proxies=self._nopx)
+        for version in versions:
+            url = f"{self.BASE}/messenger/{version}/accounts/{self.user_id}/chats/{chat_id}/messages"
+            r = self._r.post(url, headers=headers, json=body, timeout=self.TIMEOUT, proxies=self._nopx)
+            if r.status_code in (404, 405) and version != versions[-1]:
+                logger.debug(f"API {version} недоступно для отправки, пробуем следующую версию")
+                continue
+            break
+        if r.status_code in (404, 405) and self._send_version:
+            self._send_version = None
         r.raise_for_status()
+        self._send_version = version
         logger.info(f"Сообщение отправлено в чат {chat_id}")
         return r.json()
+
+    def upload_image(self, path: str) -> str:
+        """Загружает изображение и возвращает его image_id (метод принимает одно изображение за запрос)."""
+        with open(path, "rb") as f:
+            r = self._r.post(
+                f"{self.BASE}/messenger/v1/accounts/{self.user_id}/uploadImages",
+                headers=self._headers(), files={"uploadfile[]": f}, timeout=self.TIMEOUT, proxies=self._nopx
+            )
+        r.raise_for_status()
+        data = r.json() or {}
+        if not data:
+            raise RuntimeError(f"uploadImages: пустой ответ для {path}")
+        return next(iter(data))
+
+    def send_image(self, chat_id: str, image_id: str) -> Dict[str, Any]:
+        logger.info(f"Отправка изображения {image_id} в чат {chat_id}")
+        r = self._r.post(
+            f"{self.BASE}/messenger/v1/accounts/{self.user_id}/chats/{chat_id}/messages/image",
+            headers=self._headers() | {"Content-Type": "application/json"},
+            json={"image_id": image_id}, timeout=self.TIMEOUT, proxies=self._nopx
+        )
+        r.raise_for_status()
+        return r.json()
     
     def force_refresh_token(self):
         """Принудительно обновить токен"""
@@ -0,0 +1,245 @@
+import io
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone, timedelta
+from typing import Any, List, Optional
+from msgspec import Raw
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from .avito_client import AvitoClient, MAX_OFFSET, MAX_PAGE_SIZE
+from .db import BackfillCheckpoint
+from .processor import message_row
+from .models import AvitoMessage
+
+logger = logging.getLogger(__name__)
+
+# порядок колонок в COPY; raw идет как JSON-текст
+_COPY_COLUMNS = ("id", "chat_id", "author_id", "direction", "type", "text", "created_ts", "is_read", "raw")
+
+_STAGE_DDL = (
+    "CREATE TEMP TABLE IF NOT EXISTS backfill_stage "
+    "(LIKE messages INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+)
+
+
+def _copy_value(v: Any) -> str:
+    """Значение в текстовом формате COPY (NULL = \\N, экранируем спецсимволы)."""
+    if v is None:
+        return "\\N"
+    if isinstance(v, bool):
+        return "t" if v else "f"
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if isinstance(v, Raw):
+        v = bytes(v).decode()
+    elif isinstance(v, dict):
+        v = json.dumps(v, ensure_ascii=False)
+    s = str(v).replace("\x00", "")
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _copy_buffer(chat_id: str, msgs: List[AvitoMessage]) -> io.StringIO:
+    buf = io.StringIO()
+    for m in msgs:
+        if not m.id:
+            continue
+        row = message_row(chat_id, m)
+        buf.write("\t".join(_copy_value(row[c]) for c in _COPY_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
+def copy_messages(engine, chat_id: str, msgs: List[AvitoMessage], next_offset: int, done: bool,
+                  truncated: bool = False) -> int:
+    """
+    Загружает страницу сообщений через COPY во временную таблицу и переносит в messages
+    без дубликатов. Чекпоинт чата обновляется в той же транзакции, поэтому после падения
+    загрузка продолжается ровно с последней сохраненной страницы.
+    Возвращает число реально вставленных сообщений.
+    """
+    cols = ", ".join(_COPY_COLUMNS)
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(_STAGE_DDL)
+        cur.execute("INSERT INTO chats (id) VALUES (%s) ON CONFLICT (id) DO NOTHING", (chat_id,))
+        cur.copy_expert(f"COPY backfill_stage ({cols}) FROM STDIN", _copy_buffer(chat_id, msgs))
+        cur.execute(
+            f"INSERT INTO messages ({cols}) SELECT {cols} FROM backfill_stage ON CONFLICT (id) DO NOTHING"
+        )
+        inserted = cur.rowcount
+        cur.execute(
+            "UPDATE backfill_checkpoints SET next_offset = %s, loaded = loaded + %s, done = %s, truncated = %s, "
+            "updated = now() WHERE chat_id = %s",
+            (next_offset, inserted, done, truncated, chat_id),
+        )
+        conn.commit()
+        return inserted
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+class _Progress:
+    def __init__(self, total_chats: int):
+        self.total_chats = total_chats
+        self.done_chats = 0
+        self.failed_chats = 0
+        self.truncated_chats = 0
+        self.pages = 0
+        self.messages = 0
+        self.skipped_live = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_page(self, inserted: int, skipped_live: int = 0):
+        with self._lock:
+            self.pages += 1
+            self.messages += inserted
+            self.skipped_live += skipped_live
+
+    def chat_truncated(self):
+        with self._lock:
+            self.truncated_chats += 1
+
+    def chat_finished(self, ok: bool):
+        with self._lock:
+            if ok:
+                self.done_chats += 1
+            else:
+                self.failed_chats += 1
+
+    def report(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            finished = self.done_chats + self.failed_chats
+            left = self.total_chats - finished
+            rate = self.messages / elapsed if elapsed > 0 else 0.0
+            eta = (elapsed / finished * left) if finished else None
+            eta_str = f"{int(eta // 60)} мин {int(eta % 60)} сек" if eta is not None else "?"
+            logger.info(
+                f"Backfill: чатов {finished}/{self.total_chats} (ошибок {self.failed_chats}, "
+                f"обрезано лимитом API {self.truncated_chats}), "
+                f"страниц {self.pages}, сообщений {self.messages} ({rate:.1f}/с), ETA {eta_str}"
+            )
+
+
+def _list_all_chat_ids(avito: AvitoClient) -> List[str]:
+    ids: List[str] = []
+    offset = 0
+    while offset <= MAX_OFFSET:
+        items = avito.list_chats(limit=MAX_PAGE_SIZE, offset=offset, unread_only=False)
+        ids.extend(ch.id for ch in items if ch.id)
+        if len(items) < MAX_PAGE_SIZE:
+            return ids
+        offset += MAX_PAGE_SIZE
+    logger.warning(
+        f"Backfill: API не отдает чаты глубже offset={MAX_OFFSET}; "
+        f"загружаются только {len(ids)} последних по активности чатов"
+    )
+    return ids
+
+
+def _left_to_poller(m: AvitoMessage, live_since: datetime) -> bool:
+    return (
+        m.direction == "in" and not m.is_read
+        and m.created is not None and datetime.fromtimestamp(m.created, tz=timezone.utc) >= live_since
+    )
+
+
+def _backfill_chat(avito: AvitoClient, engine, chat_id: str, offset: int, page_size: int,
+                   live_since: Optional[datetime], progress: _Progress):
+    while True:
+        if offset > MAX_OFFSET:
+            # дальше API не пускает: чат закрываем как обрезанный, иначе он перезапускался бы вечно
+            copy_messages(engine, chat_id, [], offset, True, truncated=True)
+            progress.chat_truncated()
+            logger.warning(f"Backfill: чат {chat_id} обрезан лимитом API, загружено {offset} последних сообщений")
+            return
+        arr = avito.get_messages(chat_id, limit=page_size, offset=offset)
+        offset += len(arr)
+        done = len(arr) < page_size
+        rows = arr
+        if live_since is not None:
+            # свежие непрочитанные входящие оставляем поллеру: вставленные здесь он счел бы
+            # дубликатами и не отправил бы уведомление/ответ. Такой чат есть в списке
+            # unread_only, поэтому поллер до них дойдет; остальное (исходящие, прочитанные)
+            # поллер не увидит — это грузим сразу
+            rows = [m for m in arr if not _left_to_poller(m, live_since)]
+        inserted = copy_messages(engine, chat_id, rows, offset, done)
+        progress.add_page(inserted, len(arr) - len(rows))
+        if done:
+            logger.debug(f"История чата {chat_id} загружена ({offset} сообщений)")
+            return
+
+
+def run_backfill(
+    avito: AvitoClient,
+    engine,
+    db_session_factory,
+    workers: int = 4,
+    page_size: int = 100,
+    report_every_sec: int = 10,
+    live_window_minutes: Optional[int] = None,
+) -> _Progress:
+    """
+    Загружает историю всех чатов в БД — в пределах, которые отдает API: не больше
+    MAX_OFFSET + страница последних чатов и последних сообщений в каждом чате.
+    Чаты, упершиеся в этот предел, отмечаются в чекпоинте как truncated.
+
+    Чаты обрабатываются параллельно в `workers` потоках; общий лимит запросов задается
+    при создании AvitoClient (rps). История пишется напрямую через COPY, минуя
+    persist_message/notify, поэтому уведомлений о ней нет. Непрочитанные входящие новее
+    live_window_minutes до старта (порог свежести поллера) пропускаются: их сохранит
+    и обработает поллер, который обходит непрочитанные чаты.
+    """
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    live_since = None
+    if live_window_minutes is not None:
+        live_since = datetime.now(tz=timezone.utc) - timedelta(minutes=max(1, live_window_minutes))
+    chat_ids = _list_all_chat_ids(avito)
+    logger.info(f"Backfill: найдено чатов {len(chat_ids)}")
+
+    with db_session_factory() as db:
+        # пачками, чтобы не упереться в лимит параметров запроса
+        for i in range(0, len(chat_ids), 1000):
+            db.execute(
+                insert(BackfillCheckpoint)
+                .values([{"chat_id": cid, "next_offset": 0, "loaded": 0, "done": False}
+                         for cid in chat_ids[i:i + 1000]])
+                .on_conflict_do_nothing(index_elements=["chat_id"])
+            )
+        db.commit()
+        pending = db.execute(
+            select(BackfillCheckpoint.chat_id, BackfillCheckpoint.next_offset)
+            .where(BackfillCheckpoint.done.is_(False))
+        ).all()
+
+    progress = _Progress(len(pending))
+    logger.info(f"Backfill: к загрузке {len(pending)} чатов, уже завершено {len(chat_ids) - len(pending)}")
+
+    def job(chat_id: str, offset: int):
+        try:
+            _backfill_chat(avito, engine, chat_id, offset, page_size, live_since, progress)
+            progress.chat_finished(True)
+        except Exception as e:
+            progress.chat_finished(False)
+            logger.error(f"Backfill: ошибка в чате {chat_id}: {type(e).__name__}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="backfill") as pool:
+        futures = {pool.submit(job, cid, off) for cid, off in pending}
+        while futures:
+            _, futures = wait(futures, timeout=report_every_sec)
+            progress.report()
+
+    logger.info(
+        f"Backfill завершен за {time.monotonic() - progress.started:.0f} сек; "
+        f"оставлено поллеру свежих сообщений: {progress.skipped_live}"
+    )
+    return progress
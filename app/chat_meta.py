@@ -0,0 +1,138 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+from .avito_client import AvitoClient
+from .db import Chat
+from .models import ChatItem
+
+logger = logging.getLogger(__name__)
+
+META_KEY = "meta"  # ключ в Chat.ctx
+
+_MERGE_META = text(
+    "UPDATE chats SET ctx = coalesce(ctx, '{}'::jsonb) || jsonb_build_object('meta', CAST(:meta AS jsonb)) "
+    "WHERE id = :chat_id"
+)
+
+
+def extract_chat_meta(ch: ChatItem, own_user_id: str) -> Dict[str, Any]:
+    """Объявление и покупатель из объекта чата (ответ list_chats / get_chat)."""
+    item = ch.context.value if ch.context is not None and ch.context.type == "item" else None
+    buyer = next((u for u in ch.users if str(u.id) != str(own_user_id)), None)
+    return {
+        "item_id": item.id if item else None,
+        "item_title": item.title if item else None,
+        "item_price": item.price_string if item else None,
+        "item_url": item.url if item else None,
+        "buyer_name": buyer.name if buyer else None,
+        "fetched_at": time.time(),
+    }
+
+
+def _same_meta(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    return {k: v for k, v in a.items() if k != "fetched_at"} == {k: v for k, v in b.items() if k != "fetched_at"}
+
+
+def format_chat_meta(meta: Optional[Dict[str, Any]]) -> str:
+    """Строки для уведомления; пустая строка, если метаданных нет."""
+    if not meta:
+        return ""
+    lines = []
+    if meta.get("item_title"):
+        price = f" ({meta['item_price']})" if meta.get("item_price") else ""
+        lines.append(f"Объявление: {meta['item_title']}{price}")
+    if meta.get("buyer_name"):
+        lines.append(f"Покупатель: {meta['buyer_name']}")
+    return "".join(line + "\n" for line in lines)
+
+
+class ChatMetaCache:
+    """
+    Метаданные чатов: LRU в памяти поверх Chat.ctx["meta"] в БД.
+
+    Основной источник — ответы list_chats, которые поллер и так получает
+    (update_from_list), поэтому в обычном случае лишних запросов к API нет.
+    Запрос /chats/{chat_id} делается лениво, только если записи нет или она старше ttl.
+    """
+
+    def __init__(self, avito: AvitoClient, ttl_sec: int = 6 * 3600, max_size: int = 10000):
+        self.avito = avito
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self._lru: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fresh(self, meta: Optional[Dict[str, Any]]) -> bool:
+        return bool(meta) and time.time() - (meta.get("fetched_at") or 0) < self.ttl_sec
+
+    def _remember(self, chat_id: str, meta: Dict[str, Any]):
+        with self._lock:
+            self._lru[chat_id] = meta
+            self._lru.move_to_end(chat_id)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def _cached(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            meta = self._lru.get(chat_id)
+            if meta is not None:
+                self._lru.move_to_end(chat_id)
+            return meta
+
+    def _store(self, db: Session, metas: Dict[str, Dict[str, Any]]):
+        """Пишет метаданные в Chat.ctx одним коммитом; неизменившиеся записи не трогает."""
+        stored = dict(db.execute(select(Chat.id, Chat.ctx).where(Chat.id.in_(list(metas)))).all())
+        dirty = False
+        for chat_id, meta in metas.items():
+            if chat_id not in stored:
+                db.add(Chat(id=chat_id, ctx={}))
+                db.flush()
+            old = (stored.get(chat_id) or {}).get(META_KEY)
+            if self._fresh(old) and _same_meta(old, meta):
+                continue
+            # меняем только ключ meta: пересказ в том же ctx пишется параллельно из фона
+            db.execute(_MERGE_META, {"meta": json.dumps(meta, ensure_ascii=False), "chat_id": chat_id})
+            dirty = True
+        if dirty:
+            db.commit()
+
+    def update_from_list(self, db: Session, items: List[ChatItem]):
+        metas = {}
+        for ch in items:
+            chat_id = ch.id
+            if not chat_id:
+                continue
+            meta = extract_chat_meta(ch, self.avito.user_id)
+            metas[chat_id] = meta
+            self._remember(chat_id, meta)
+        if metas:
+            self._store(db, metas)
+
+    def get(self, db: Session, chat_id: str) -> Optional[Dict[str, Any]]:
+        meta = self._cached(chat_id)
+        if self._fresh(meta):
+            return meta
+
+        # запись в памяти нет или она устарела — сначала БД: поллер обновляет Chat.ctx
+        # из списка чатов, и свежие данные там часто уже есть (без запроса к API)
+        ctx = db.scalar(select(Chat.ctx).where(Chat.id == chat_id))
+        stored = (ctx or {}).get(META_KEY)
+        if stored is not None and (meta is None or (stored.get("fetched_at") or 0) > (meta.get("fetched_at") or 0)):
+            meta = stored
+            self._remember(chat_id, meta)
+            if self._fresh(meta):
+                return meta
+
+        try:
+            fetched = extract_chat_meta(self.avito.get_chat(chat_id), self.avito.user_id)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить метаданные чата {chat_id}: {type(e).__name__}: {e}")
+            return meta  # лучше устаревшие данные, чем никаких
+        self._remember(chat_id, fetched)
+        self._store(db, {chat_id: fetched})
+        return fetched
@@ -1,7 +1,11 @@
 from datetime import datetime
-from sqlalchemy import create_engine, BigInteger, String, Text, DateTime, Boolean, ForeignKey
+from sqlalchemy import create_engine, BigInteger, Integer, String, Text, DateTime, Boolean, ForeignKey, Computed, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from .models import encode_json
+
+# Полнотекстовый поиск по Message.text с русской морфологией
+TSV_EXPR = "to_tsvector('russian', coalesce(text, ''))"
 
 class Base(DeclarativeBase):
     pass
@@ -24,10 +28,126 @@ class Message(Base):
     created_ts: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
     is_read: Mapped[bool | None] = mapped_column(Boolean, nullable=True)
     raw: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
+    # генерируется самой БД; deferred — чтобы не тянуть вектор при обычной загрузке сообщений
+    text_tsv: Mapped[str | None] = mapped_column(TSVECTOR, Computed(TSV_EXPR, persisted=True), deferred=True)
     chat = relationship("Chat", back_populates="messages")
 
+    __table_args__ = (
+        Index("ix_messages_text_tsv", "text_tsv", postgresql_using="gin"),
+        Index("ix_messages_chat_created", "chat_id", "created_ts", "id"),
+        Index("ix_messages_created", "created_ts", "id"),  # глобальная лента и поиск без chat_id
+    )
+
+class ChatStats(Base):
+    """Агрегат по чату, поддерживается триггерами на messages (см. ensure_schema)."""
+    __tablename__ = "chat_stats"
+    chat_id: Mapped[str] = mapped_column(String, ForeignKey("chats.id"), primary_key=True)
+    unread_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    last_message_ts: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("ix_chat_stats_last", "last_message_ts", "chat_id"),
+    )
+
+class BackfillCheckpoint(Base):
+    """Прогресс загрузки истории по чату: сколько сообщений уже пройдено с начала ленты."""
+    __tablename__ = "backfill_checkpoints"
+    chat_id: Mapped[str] = mapped_column(String, primary_key=True)
+    next_offset: Mapped[int] = mapped_column(Integer, default=0)
+    loaded: Mapped[int] = mapped_column(Integer, default=0)
+    done: Mapped[bool] = mapped_column(Boolean, default=False)
+    truncated: Mapped[bool] = mapped_column(Boolean, default=False, server_default="false")  # уперлись в лимит offset API
+    updated: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+class OutboundMessage(Base):
+    """Журнал исходящих сообщений в Авито; ключ идемпотентности защищает от повторной отправки."""
+    __tablename__ = "outbound_messages"
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    chat_id: Mapped[str] = mapped_column(String)
+    kind: Mapped[str] = mapped_column(String(8))          # text | image
+    payload: Mapped[str] = mapped_column(Text)            # текст или путь к файлу
+    status: Mapped[str] = mapped_column(String(8))        # pending | sent | failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    avito_message_id: Mapped[str | None] = mapped_column(String, nullable=True)
+    created: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
 def make_engine(db_url: str, echo: bool = False):
-    return create_engine(db_url, pool_pre_ping=True, echo=echo)
+    return create_engine(db_url, pool_pre_ping=True, echo=echo, json_serializer=encode_json)
 
 def make_session_factory(engine):
     return sessionmaker(bind=engine, expire_on_commit=False)
+
+# Непрочитанным считается входящее сообщение без отметки о прочтении
+_UNREAD = "(direction = 'in' AND is_read IS NOT TRUE)"
+
+_SCHEMA_DDL = [
+    # для баз, созданных до появления поиска (create_all не добавляет колонки в существующие таблицы)
+    f"ALTER TABLE messages ADD COLUMN IF NOT EXISTS text_tsv tsvector GENERATED ALWAYS AS ({TSV_EXPR}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_tsv ON messages USING gin (text_tsv)",
+    "ALTER TABLE backfill_checkpoints ADD COLUMN IF NOT EXISTS truncated boolean NOT NULL DEFAULT false",
+    "CREATE INDEX IF NOT EXISTS ix_messages_chat_created ON messages (chat_id, created_ts, id)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_created ON messages (created_ts, id)",
+    f"""
+    CREATE OR REPLACE FUNCTION chat_stats_on_insert() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO chat_stats (chat_id, unread_count, last_message_ts)
+        SELECT chat_id, count(*) FILTER (WHERE {_UNREAD}), max(created_ts)
+        FROM new_rows GROUP BY chat_id
+        ON CONFLICT (chat_id) DO UPDATE SET
+            unread_count = chat_stats.unread_count + EXCLUDED.unread_count,
+            last_message_ts = GREATEST(chat_stats.last_message_ts, EXCLUDED.last_message_ts);
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION chat_stats_on_update() RETURNS trigger AS $$
+    BEGIN
+        UPDATE chat_stats s SET unread_count = s.unread_count + d.delta
+        FROM (
+            SELECT n.chat_id, sum((n.direction = 'in' AND n.is_read IS NOT TRUE)::int
+                                - (o.direction = 'in' AND o.is_read IS NOT TRUE)::int) AS delta
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            GROUP BY n.chat_id
+        ) d
+        WHERE s.chat_id = d.chat_id AND d.delta <> 0;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION chat_stats_on_delete() RETURNS trigger AS $$
+    BEGIN
+        UPDATE chat_stats s SET unread_count = s.unread_count - d.cnt
+        FROM (SELECT chat_id, count(*) FILTER (WHERE {_UNREAD}) AS cnt FROM old_rows GROUP BY chat_id) d
+        WHERE s.chat_id = d.chat_id AND d.cnt > 0;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql
+    """,
+    # триггеры уровня оператора: пачка из COPY/INSERT ... SELECT обновляет агрегат одним запросом
+    "DROP TRIGGER IF EXISTS messages_chat_stats_ins ON messages",
+    "CREATE TRIGGER messages_chat_stats_ins AFTER INSERT ON messages "
+    "REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION chat_stats_on_insert()",
+    "DROP TRIGGER IF EXISTS messages_chat_stats_upd ON messages",
+    "CREATE TRIGGER messages_chat_stats_upd AFTER UPDATE ON messages "
+    "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION chat_stats_on_update()",
+    "DROP TRIGGER IF EXISTS messages_chat_stats_del ON messages",
+    "CREATE TRIGGER messages_chat_stats_del AFTER DELETE ON messages "
+    "REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION chat_stats_on_delete()",
+]
+
+# первичное заполнение агрегата, если таблица только что появилась в существующей базе
+_SEED_STATS = f"""
+    INSERT INTO chat_stats (chat_id, unread_count, last_message_ts)
+    SELECT chat_id, count(*) FILTER (WHERE {_UNREAD}), max(created_ts) FROM messages GROUP BY chat_id
+    ON CONFLICT (chat_id) DO NOTHING
+"""
+
+def ensure_schema(engine):
+    """Создает таблицы и то, что create_all не умеет: триггеры агрегата и доп. колонки старых баз."""
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE")
+        for stmt in _SCHEMA_DDL:
+            conn.exec_driver_sql(stmt)
+        if conn.exec_driver_sql("SELECT NOT EXISTS (SELECT 1 FROM chat_stats)").scalar():
+            conn.exec_driver_sql(_SEED_STATS)
@@ -0,0 +1,267 @@
+import json
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Deque, List, NamedTuple, Optional
+from sqlalchemy import select, text, tuple_
+from .db import Chat, Message
+from .llm_governor import estimate_tokens
+from .models import AvitoMessage
+from .processor import message_row
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_KEY = "summary"  # ключ в Chat.ctx: {"text", "upto_ts", "upto_id"}
+
+_SUMMARY_PROMPT = (
+    "Кратко (не больше {max_chars} символов) перескажи переписку продавца с покупателем на Авито: "
+    "что обсуждали, о чем договорились, какие вопросы остались открытыми. "
+    "Обнови прежний пересказ новыми сообщениями.\n\n"
+    "Прежний пересказ:\n{summary}\n\nНовые сообщения:\n{turns}"
+)
+
+_MERGE_SUMMARY = text(
+    "UPDATE chats SET ctx = coalesce(ctx, '{}'::jsonb) || jsonb_build_object('summary', CAST(:summary AS jsonb)) "
+    "WHERE id = :chat_id"
+)
+
+
+def _turn(direction: Optional[str], body: str) -> str:
+    who = "Покупатель" if direction == "in" else "Продавец"
+    return f"{who}: {body}"
+
+
+class _Turn(NamedTuple):
+    id: str
+    direction: Optional[str]
+    text: str
+    created_ts: datetime
+    cost: int
+
+
+@dataclass
+class _Window:
+    """Кэш чата: окно последних сообщений (от старых к новым) и сохраненный пересказ."""
+    turns: Deque[_Turn] = field(default_factory=deque)
+    used: int = 0
+    summary: dict = field(default_factory=dict)
+
+
+class ContextBuilder:
+    """
+    Контекст переписки для вопроса к GPT при ограниченном размере промпта.
+
+    Последние сообщения чата берутся из БД от новых к старым, пока помещаются в
+    token_budget. Все, что старше этого окна, сворачивается в краткий пересказ в
+    Chat.ctx["summary"]. Пересказ обновляется в фоне и только для чатов, дошедших до GPT:
+    prompt() ставит schedule после сборки контекста. Дописывается вся часть истории между
+    курсором пересказа и окном, страницами по fold_page сообщений в порядке (created_ts, id).
+    Вопрос покупателя не ждет пересказа — берется последний сохраненный.
+
+    Окно и пересказ кэшируются по чату (LRU на cache_size чатов): новые сообщения
+    дописываются в окно через note_message при сохранении, пересказ — после свертки,
+    поэтому вопрос в активном чате собирается без запросов к БД.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        summarize_fn: Callable[[str], str],
+        token_budget: int = 1500,
+        max_turns: int = 50,
+        summary_max_chars: int = 1000,
+        fold_page: int = 50,
+        workers: int = 1,
+        cache_size: int = 1000,
+    ):
+        self.session_factory = session_factory
+        self.summarize_fn = summarize_fn
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.summary_max_chars = summary_max_chars
+        self.fold_page = fold_page
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, _Window] = OrderedDict()
+        self._loading: dict[str, bool] = {}  # чат читается из БД -> пришло ли за это время сообщение
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="summary")
+        self._scheduled: set[str] = set()
+        self._rerun: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _recent(self, db, chat_id: str) -> List:
+        """Окно последних сообщений, помещающееся в token_budget (от новых к старым)."""
+        rows = db.execute(
+            select(Message.id, Message.direction, Message.text, Message.created_ts)
+            .where(Message.chat_id == chat_id, Message.created_ts.is_not(None), Message.text.is_not(None))
+            .order_by(Message.created_ts.desc(), Message.id.desc())
+            .limit(self.max_turns)
+        ).all()
+        recent, used = [], 0
+        for r in rows:
+            cost = estimate_tokens(r.text)
+            if recent and used + cost > self.token_budget:
+                break
+            recent.append(r)
+            used += cost
+        return recent
+
+    def _trim(self, w: _Window):
+        while len(w.turns) > self.max_turns or (w.used > self.token_budget and len(w.turns) > 1):
+            w.used -= w.turns.popleft().cost
+
+    def _remember(self, chat_id: str, w: _Window):
+        with self._lock:
+            self._cache[chat_id] = w
+            self._cache.move_to_end(chat_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def note_message(self, chat_id: str, msg: AvitoMessage):
+        """Дописывает сохраненное сообщение в окно закэшированного чата (без запросов к БД)."""
+        row = message_row(chat_id, msg)
+        if row["text"] is None or row["created_ts"] is None:
+            return
+        turn = _Turn(row["id"], row["direction"], row["text"], row["created_ts"], estimate_tokens(row["text"]))
+        with self._lock:
+            if chat_id in self._loading:
+                self._loading[chat_id] = True
+            w = self._cache.get(chat_id)
+            if w is None:
+                return
+            if w.turns and (turn.created_ts, turn.id) <= (w.turns[-1].created_ts, w.turns[-1].id):
+                # пришло не по порядку — проще перечитать окно из БД при следующем вопросе
+                self._cache.pop(chat_id, None)
+                return
+            w.turns.append(turn)
+            w.used += turn.cost
+            self._trim(w)
+
+    def _load(self, chat_id: str) -> _Window:
+        with self.session_factory() as db:
+            recent = self._recent(db, chat_id)
+            summary = self._summary(db, chat_id)
+        w = _Window(summary=summary)
+        for r in reversed(recent):
+            w.turns.append(_Turn(r.id, r.direction, r.text, r.created_ts, estimate_tokens(r.text)))
+            w.used += w.turns[-1].cost
+        return w
+
+    @staticmethod
+    def _summary(db, chat_id: str) -> dict:
+        ctx = db.scalar(select(Chat.ctx).where(Chat.id == chat_id))
+        return (ctx or {}).get(SUMMARY_KEY) or {}
+
+    def schedule(self, chat_id: str):
+        """Ставит обновление пересказа чата в фон; повторные вызовы во время работы объединяются."""
+        with self._lock:
+            if chat_id in self._scheduled:
+                self._rerun.add(chat_id)
+                return
+            self._scheduled.add(chat_id)
+        self._executor.submit(self._refresh, chat_id)
+
+    def _refresh(self, chat_id: str):
+        try:
+            while True:
+                self.fold(chat_id)
+                with self._lock:
+                    if chat_id not in self._rerun:
+                        self._scheduled.discard(chat_id)
+                        return
+                    self._rerun.discard(chat_id)
+        except Exception as e:
+            with self._lock:
+                self._scheduled.discard(chat_id)
+                self._rerun.discard(chat_id)
+            logger.warning(f"Не удалось обновить пересказ чата {chat_id}: {type(e).__name__}: {e}")
+
+    def fold(self, chat_id: str):
+        """Дописывает в пересказ все сообщения от курсора до начала окна, страницами."""
+        with self.session_factory() as db:
+            recent = self._recent(db, chat_id)
+            if not recent:
+                return
+            window_start = (recent[-1].created_ts, recent[-1].id)
+            summary = self._summary(db, chat_id)
+            while True:
+                q = (
+                    select(Message.id, Message.direction, Message.text, Message.created_ts)
+                    .where(
+                        Message.chat_id == chat_id, Message.created_ts.is_not(None), Message.text.is_not(None),
+                        tuple_(Message.created_ts, Message.id) < tuple_(*window_start),
+                    )
+                    .order_by(Message.created_ts, Message.id)
+                    .limit(self.fold_page)
+                )
+                if summary.get("upto_ts"):
+                    upto = (datetime.fromisoformat(summary["upto_ts"]), summary["upto_id"])
+                    q = q.where(tuple_(Message.created_ts, Message.id) > tuple_(*upto))
+                page = db.execute(q).all()
+                if not page:
+                    return
+                prompt = _SUMMARY_PROMPT.format(
+                    max_chars=self.summary_max_chars,
+                    summary=summary.get("text") or "(нет)",
+                    turns="\n".join(_turn(r.direction, r.text) for r in page),
+                )
+                new_text = self.summarize_fn(prompt).strip()[:self.summary_max_chars]
+                last = page[-1]
+                summary = {"text": new_text, "upto_ts": last.created_ts.isoformat(), "upto_id": last.id}
+                db.execute(_MERGE_SUMMARY, {"summary": json.dumps(summary, ensure_ascii=False), "chat_id": chat_id})
+                db.commit()
+                with self._lock:
+                    if chat_id in self._cache:
+                        self._cache[chat_id].summary = summary
+                if len(page) < self.fold_page:
+                    return
+
+    def context(self, chat_id: str, exclude_id: Optional[str] = None) -> str:
+        """Пересказ и последние сообщения; exclude_id — сообщение с самим вопросом."""
+        with self._lock:
+            w = self._cache.get(chat_id)
+            if w is not None:
+                self._cache.move_to_end(chat_id)
+                turns, summary = list(w.turns), w.summary
+        if w is None:
+            with self._lock:
+                self._loading.setdefault(chat_id, False)
+            try:
+                w = self._load(chat_id)
+            finally:
+                with self._lock:
+                    missed = self._loading.pop(chat_id, True)
+            if not missed:  # иначе окно могло пропустить сообщение, сохраненное во время чтения
+                self._remember(chat_id, w)
+            turns, summary = list(w.turns), w.summary
+        turns = [t for t in turns if t.id != exclude_id]
+        if not turns and not summary.get("text"):
+            return ""
+
+        parts = []
+        if summary.get("text"):
+            parts.append(f"Краткое содержание ранней переписки:\n{summary['text']}")
+        if turns:
+            parts.append("Последние сообщения:\n" + "\n".join(_turn(t.direction, t.text) for t in turns))
+        return "\n\n".join(parts)
+
+    def prompt(self, chat_id: str, question: str, msg_id: Optional[str] = None) -> str:
+        """
+        Вопрос покупателя с контекстом чата; сообщение msg_id (в котором задан вопрос)
+        в контекст не входит, чтобы не повторять его. При ошибке БД — просто вопрос.
+        """
+        try:
+            ctx = self.context(chat_id, exclude_id=msg_id)
+        except Exception as e:
+            logger.warning(f"Не удалось собрать контекст чата {chat_id}: {type(e).__name__}: {e}")
+            ctx = ""
+        # пересказ дописываем в фоне — пригодится следующему вопросу этого чата
+        self.schedule(chat_id)
+        if not ctx:
+            return question
+        return (
+            "Ты помогаешь продавцу на Авито ответить покупателю.\n\n"
+            f"{ctx}\n\nВопрос: {question}"
+        )
@@ -0,0 +1,160 @@
+import time
+import heapq
+import hashlib
+import logging
+import itertools
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+import requests
+
+logger = logging.getLogger(__name__)
+
+# меньше — раньше: свежие вопросы покупателей обгоняют повторы после ошибок
+PRIORITY_FRESH = 0
+PRIORITY_BACKGROUND = 5  # служебные запросы, например пересказ переписки
+PRIORITY_RETRY = 10
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка без токенизатора: для русского текста ~3 символа на токен."""
+    return len(text) // 3 + 1
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return False
+
+
+class _TokenBucket:
+    """Бюджет токенов в минуту; без своей блокировки — вызывается под условием губернатора."""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: int) -> float:
+        """Списывает cost и возвращает 0, либо возвращает, сколько секунд ждать."""
+        if not self.capacity:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.capacity)  # запрос больше минутного бюджета все равно должен пройти
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class LLMGovernor:
+    """
+    Ограничитель перед ask_gpt:
+    - не больше max_concurrency запросов одновременно;
+    - не больше tokens_per_minute оценочных токенов (0 — без ограничения);
+    - очередь с приоритетом: повторы после ошибок идут после свежих вопросов;
+    - одинаковые вопросы, заданные одновременно, выполняются одним запросом.
+    Методы блокирующие, рассчитаны на вызов из потоков поллера и фоновых задач вебхука.
+    """
+
+    def __init__(
+        self,
+        ask_fn: Callable[[str], str],
+        max_concurrency: int = 4,
+        tokens_per_minute: int = 0,
+        max_retries: int = 2,
+        retry_backoff_sec: float = 2.0,
+        output_tokens_reserve: int = 500,
+    ):
+        self.ask_fn = ask_fn
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.retry_backoff_sec = retry_backoff_sec
+        self.output_tokens_reserve = output_tokens_reserve
+        self._cond = threading.Condition()
+        self._queue: List[Tuple[int, int]] = []  # heap (priority, seq)
+        self._seq = itertools.count()
+        self._running = 0
+        self._bucket = _TokenBucket(tokens_per_minute)
+        self._inflight: Dict[str, Future] = {}
+        self._calls = 0
+        self._coalesced = 0
+
+    def _acquire(self, priority: int, cost: int):
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._queue, entry)
+            while True:
+                if self._queue[0] == entry and self._running < self.max_concurrency:
+                    wait_for = self._bucket.take(cost)
+                    if not wait_for:
+                        heapq.heappop(self._queue)
+                        self._running += 1
+                        self._calls += 1
+                        self._cond.notify_all()  # следующий в очереди может пройти сразу
+                        return
+                    self._cond.wait(wait_for)
+                else:
+                    self._cond.wait()
+
+    def _release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def _call(self, prompt: str, priority: int) -> str:
+        cost = estimate_tokens(prompt) + self.output_tokens_reserve
+        attempt = 0
+        while True:
+            self._acquire(priority if attempt == 0 else PRIORITY_RETRY, cost)
+            try:
+                return self.ask_fn(prompt)
+            except Exception as e:
+                if attempt >= self.max_retries or not _retryable(e):
+                    raise
+                logger.warning(f"GPT: ошибка {type(e).__name__}, повтор {attempt + 1}/{self.max_retries}")
+            finally:
+                self._release()
+            # ждем вне слота, чтобы не занимать его у других запросов
+            time.sleep(self.retry_backoff_sec * 2 ** attempt)
+            attempt += 1
+
+    def ask(self, prompt: str, priority: int = PRIORITY_FRESH) -> str:
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        with self._cond:
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._inflight[key] = Future()
+            else:
+                self._coalesced += 1
+        if not leader:
+            logger.debug("GPT: одинаковый вопрос уже выполняется, ждем его ответ")
+            return fut.result()
+
+        try:
+            result = self._call(prompt, priority)
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            with self._cond:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "running": self._running,
+                "queued": len(self._queue),
+                "inflight_prompts": len(self._inflight),
+                "calls": self._calls,
+                "coalesced": self._coalesced,
+            }
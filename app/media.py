@@ -0,0 +1,175 @@
+import os
+import hashlib
+import logging
+import tempfile
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import requests
+from .avito_client import AvitoClient
+from .models import AvitoMessage
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class StoredMedia:
+    kind: str   # voice | image
+    path: str
+    sha256: str
+    size: int
+
+
+def _largest_image_url(sizes: Dict[str, str]) -> Optional[str]:
+    """Из словаря {"ШxВ": url} выбирает ссылку на самое большое изображение."""
+    def area(key: str) -> int:
+        try:
+            w, h = key.lower().split("x", 1)
+            return int(w) * int(h)
+        except ValueError:
+            return 0
+    if not sizes:
+        return None
+    return sizes[max(sizes, key=area)]
+
+
+def media_ref(msg: AvitoMessage) -> Optional[tuple[str, str]]:
+    """(kind, ключ) для медиа-сообщения: voice_id для голосовых, ссылка для изображений."""
+    content = msg.content
+    if content is None:
+        return None
+    if msg.type == "voice" and content.voice is not None and content.voice.voice_id:
+        return "voice", content.voice.voice_id
+    if msg.type == "image" and content.image is not None:
+        url = _largest_image_url(content.image.sizes)
+        if url:
+            return "image", url
+    return None
+
+
+class MediaStore:
+    """
+    Контентно-адресуемое хранилище: файл лежит по sha256 своего содержимого
+    (root/ab/cd/<sha256><ext>), поэтому одинаковые медиа хранятся один раз.
+    Дополнительно root/refs/<sha256(ключа)> запоминает, какой файл соответствует
+    voice_id/ссылке, чтобы не скачивать его повторно.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._http = requests.Session()
+        self._http.trust_env = False
+        self._nopx = {"http": None, "https": None}
+        os.makedirs(os.path.join(root, "refs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def _blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + ext)
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.root, "refs", hashlib.sha256(key.encode()).hexdigest())
+
+    def lookup(self, key: str, kind: str) -> Optional[StoredMedia]:
+        try:
+            with open(self._ref_path(key)) as f:
+                digest, ext = f.read().split("\t", 1)
+        except (OSError, ValueError):
+            return None
+        path = self._blob_path(digest, ext)
+        if not os.path.exists(path):
+            return None
+        return StoredMedia(kind=kind, path=path, sha256=digest, size=os.path.getsize(path))
+
+    def fetch(self, key: str, kind: str, url: str, ext: str) -> StoredMedia:
+        """Скачивает файл кусками во временный файл, считая хэш на лету, затем переносит на место."""
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as out, \
+                    self._http.get(url, stream=True, timeout=60, proxies=self._nopx) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"файл больше {self.max_bytes} байт")
+                    h.update(chunk)
+                    out.write(chunk)
+            digest = h.hexdigest()
+            path = self._blob_path(digest, ext)
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with open(self._ref_path(key), "w") as f:
+            f.write(f"{digest}\t{ext}")
+        return StoredMedia(kind=kind, path=path, sha256=digest, size=size)
+
+
+class MediaPipeline:
+    """Готовит файлы голосовых и изображений для пачки сообщений."""
+
+    def __init__(self, avito: AvitoClient, store: MediaStore, workers: int = 4):
+        self.avito = avito
+        self.store = store
+        self.workers = max(1, workers)
+
+    def prepare(self, msgs: List[AvitoMessage]) -> Dict[str, StoredMedia]:
+        """
+        Возвращает {id сообщения: файл}. Ссылки на голосовые получаются одним пакетным
+        запросом getVoiceFiles, загрузка идет параллельно; ошибки по отдельным файлам
+        логируются и не мешают остальным.
+        """
+        result: Dict[str, StoredMedia] = {}
+        todo: List[tuple[str, str, str]] = []   # (msg_id, kind, key)
+        for m in msgs:
+            ref = media_ref(m)
+            if not ref or not m.id:
+                continue
+            kind, key = ref
+            stored = self.store.lookup(key, kind)
+            if stored:
+                result[m.id] = stored
+            else:
+                todo.append((m.id, kind, key))
+        if not todo:
+            return result
+
+        voice_ids = sorted({key for _, kind, key in todo if kind == "voice"})
+        voice_urls: Dict[str, str] = {}
+        if voice_ids:
+            try:
+                voice_urls = self.avito.get_voice_files(voice_ids)
+            except Exception as e:
+                logger.error(f"Не удалось получить ссылки на голосовые: {type(e).__name__}: {e}")
+
+        # одинаковые ключи в пачке скачиваем один раз
+        jobs: Dict[str, tuple[str, str, str]] = {}
+        for _, kind, key in todo:
+            url = voice_urls.get(key) if kind == "voice" else key
+            if url and key not in jobs:
+                jobs[key] = (kind, url, ".m4a" if kind == "voice" else ".jpg")
+
+        def download(key: str):
+            kind, url, ext = jobs[key]
+            try:
+                return key, self.store.fetch(key, kind, url, ext)
+            except Exception as e:
+                logger.error(f"Не удалось скачать медиа {kind} {key}: {type(e).__name__}: {e}")
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="media") as pool:
+            fetched = dict(pool.map(download, jobs))
+
+        for mid, _, key in todo:
+            if fetched.get(key):
+                result[mid] = fetched[key]
+        return result
@@ -0,0 +1,235 @@
+import time
+import logging
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from .avito_client import AvitoClient
+from .db import OutboundMessage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Item:
+    key: str
+    chat_id: str
+    kind: str      # text | image
+    payload: str   # текст или путь к изображению
+    attempts: int = 0
+    image_id: Optional[str] = None
+
+
+def make_key(chat_id: str, kind: str, payload: str, source: Optional[str] = None) -> str:
+    """
+    Ключ идемпотентности. С источником ("{msg.id}:gpt", "{msg.id}:rule:{name}") — только
+    источник и вид: ответ GPT при повторной обработке того же сообщения будет другим
+    текстом, но тем же ключом. Без источника — по содержимому.
+    """
+    if source:
+        return hashlib.sha256(f"{chat_id}\x00{source}:{kind}".encode()).hexdigest()
+    return hashlib.sha256(f"{chat_id}\x00\x00{kind}\x00{payload}".encode()).hexdigest()
+
+
+def send_reply(avito: AvitoClient, outbound: Optional["OutboundQueue"], chat_id: str, text: Optional[str],
+               source: Optional[str] = None, image: Optional[str] = None):
+    """Ответ в чат Авито: через очередь, если она есть, иначе сразу (текст, затем изображение)."""
+    if outbound is not None:
+        if text:
+            outbound.enqueue_text(chat_id, text, source)
+        if image:
+            outbound.enqueue_image(chat_id, image, source)
+        return
+    if text:
+        avito.send_text(chat_id, text)
+    if image:
+        avito.send_image(chat_id, avito.upload_image(image))
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих сообщений в Авито.
+
+    - в пределах чата сообщения уходят строго по порядку (FIFO), разные чаты — параллельно
+      в `workers` потоках;
+    - каждое сообщение регистрируется в outbound_messages под ключом идемпотентности:
+      уже отправленное (или стоящее в очереди) повторно не ставится и не отправляется;
+    - при ошибке сообщение остается в голове очереди своего чата и повторяется с паузой,
+      пока не кончатся попытки, — следующие сообщения этого чата ждут его;
+    - изображения, идущие подряд в голове очереди чата, загружаются через uploadImages
+      одной пачкой параллельно, затем отправляются по порядку через /messages/image.
+    """
+
+    def __init__(self, avito: AvitoClient, session_factory, workers: int = 4,
+                 max_attempts: int = 5, retry_backoff_sec: float = 2.0):
+        self.avito = avito
+        self.session_factory = session_factory
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.retry_backoff_sec = retry_backoff_sec
+        self._cond = threading.Condition()
+        self._chats: Dict[str, Deque[_Item]] = {}
+        self._ready: Deque[str] = deque()   # чаты с сообщениями, которые сейчас никто не обрабатывает
+        self._busy: set[str] = set()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        self._restore_pending()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"Очередь исходящих запущена: потоков={self.workers}")
+
+    def _restore_pending(self):
+        """Возвращает в очередь сообщения, не отправленные до перезапуска (в исходном порядке)."""
+        with self.session_factory() as db:
+            rows = db.scalars(
+                select(OutboundMessage).where(OutboundMessage.status == "pending").order_by(OutboundMessage.created)
+            ).all()
+        for row in rows:
+            self._push(_Item(row.key, row.chat_id, row.kind, row.payload, attempts=row.attempts or 0))
+        if rows:
+            logger.info(f"Восстановлено неотправленных сообщений: {len(rows)}")
+
+    def _push(self, item: _Item):
+        with self._cond:
+            q = self._chats.setdefault(item.chat_id, deque())
+            q.append(item)
+            if item.chat_id not in self._busy and len(q) == 1:
+                self._ready.append(item.chat_id)
+                self._cond.notify()
+
+    def _register(self, item: _Item) -> bool:
+        """Записывает сообщение в журнал; False, если такой ключ уже есть."""
+        with self.session_factory() as db:
+            res = db.execute(
+                insert(OutboundMessage)
+                .values(key=item.key, chat_id=item.chat_id, kind=item.kind, payload=item.payload,
+                        status="pending", attempts=0, created=datetime.now(tz=timezone.utc))
+                .on_conflict_do_nothing(index_elements=["key"])
+            )
+            db.commit()
+            return res.rowcount == 1
+
+    def _enqueue(self, chat_id: str, kind: str, payload: str, source: Optional[str]) -> bool:
+        item = _Item(make_key(chat_id, kind, payload, source), chat_id, kind, payload)
+        if not self._register(item):
+            logger.info(f"Исходящее {kind} в чат {chat_id} уже было поставлено (ключ {item.key[:12]}), пропускаем")
+            return False
+        self._push(item)
+        return True
+
+    def enqueue_text(self, chat_id: str, text: str, source: Optional[str] = None) -> bool:
+        return self._enqueue(chat_id, "text", text, source)
+
+    def enqueue_image(self, chat_id: str, path: str, source: Optional[str] = None) -> bool:
+        return self._enqueue(chat_id, "image", path, source)
+
+    def _mark(self, item: _Item, status: str, avito_message_id: Optional[str] = None):
+        try:
+            with self.session_factory() as db:
+                row = db.get(OutboundMessage, item.key)
+                if row is None:
+                    return
+                row.status = status
+                row.attempts = item.attempts
+                if avito_message_id:
+                    row.avito_message_id = avito_message_id
+                if status == "sent":
+                    row.sent_at = datetime.now(tz=timezone.utc)
+                db.commit()
+        except Exception as e:
+            # сообщение уже ушло (или окончательно не ушло) — очередь чата не должна из-за этого встать
+            logger.error(f"Не удалось записать статус {status} для {item.key[:12]}: {type(e).__name__}: {e}")
+
+    def _upload_images(self, items: List[_Item]):
+        pending = [it for it in items if it.image_id is None]
+        if not pending:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(pending), 4), thread_name_prefix="upload") as pool:
+            ids = list(pool.map(lambda it: self._try_upload(it), pending))
+        for it, image_id in zip(pending, ids):
+            it.image_id = image_id
+
+    def _try_upload(self, item: _Item) -> Optional[str]:
+        try:
+            return self.avito.upload_image(item.payload)
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить изображение {item.payload}: {type(e).__name__}: {e}")
+            return None
+
+    def _send(self, item: _Item):
+        if item.kind == "text":
+            resp = self.avito.send_text(item.chat_id, item.payload)
+        else:
+            if item.image_id is None:
+                item.image_id = self.avito.upload_image(item.payload)
+            resp = self.avito.send_image(item.chat_id, item.image_id)
+        return (resp or {}).get("id")
+
+    def _process_chat(self, chat_id: str):
+        """Отправляет все сообщения чата по порядку; вызывается только одним потоком на чат."""
+        while True:
+            with self._cond:
+                q = self._chats.get(chat_id)
+                if not q:
+                    self._chats.pop(chat_id, None)
+                    return
+                item = q[0]
+                images = []
+                if item.kind == "image":
+                    for it in q:
+                        if it.kind != "image":
+                            break
+                        images.append(it)
+            if len(images) > 1:
+                self._upload_images(images)
+
+            item.attempts += 1
+            try:
+                message_id = self._send(item)
+            except Exception as e:
+                if item.attempts < self.max_attempts:
+                    logger.warning(f"Ошибка отправки в чат {chat_id} (попытка {item.attempts}/{self.max_attempts}): "
+                                   f"{type(e).__name__}: {e}")
+                    time.sleep(self.retry_backoff_sec * 2 ** (item.attempts - 1))
+                    continue
+                logger.error(f"Сообщение в чат {chat_id} не отправлено после {item.attempts} попыток: {e}")
+                self._mark(item, "failed")
+            else:
+                self._mark(item, "sent", message_id)
+            with self._cond:
+                q.popleft()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                chat_id = self._ready.popleft()
+                self._busy.add(chat_id)
+            try:
+                self._process_chat(chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка очереди исходящих для чата {chat_id}: {type(e).__name__}: {e}", exc_info=True)
+            finally:
+                with self._cond:
+                    self._busy.discard(chat_id)
+                    # пока обрабатывали, могли добавиться новые сообщения
+                    if self._chats.get(chat_id):
+                        self._ready.append(chat_id)
+                        self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "chats": len(self._chats),
+                "queued": sum(len(q) for q in self._chats.values()),
+                "busy": len(self._busy),
+            }
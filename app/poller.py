@@ -1,8 +1,9 @@
 import time
 import logging
 from datetime import datetime, timezone, timedelta
-from .avito_client import AvitoClient
-from .processor import persist_message, notify_and_optionally_ask_gpt
+from .avito_client import AvitoClient, MAX_OFFSET
+from .outbound import send_reply
+from .processor import persist_message, notify_and_optionally_ask_gpt, should_notify, sync_read_state
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,6 +18,12 @@ def run_polling_loop(
     ask_gpt_fn_factory,     # -> callable(text)->str
     reply_avito: bool = False,
     only_since_minutes: int = 180,  # порог свежести
+    media_pipeline=None,            # MediaPipeline или None
+    chat_meta_cache=None,           # ChatMetaCache или None
+    routing=None,                   # RoutingEngine или None (только "для gpt")
+    context_builder=None,           # ContextBuilder или None (вопрос без истории)
+    outbound=None,                  # OutboundQueue или None (ответы отправляются сразу)
+    read_marker=None,               # ReadMarker или None (чаты не отмечаются прочитанными)
 ):
     seen: set[str] = set()
     cycle_count = 0
@@ -42,18 +49,26 @@ def run_polling_loop(
             total_chats = 0
             total_messages = 0
             new_messages = 0
+            cycle_started = datetime.now(tz=timezone.utc)
+            unread_ids: set[str] = set()  # полный список непрочитанных чатов по данным Авито
+            unread_complete = True
             
             while True:
+                if offset > MAX_OFFSET:
+                    logger.warning(f"Список чатов глубже offset={MAX_OFFSET} API не отдает, остальные — в следующих циклах")
+                    unread_complete = False
+                    break
                 logger.debug(f"Запрос чатов: offset={offset}")
                 # Сначала пробуем получить только чаты с непрочитанными сообщениями
-                chats = avito.list_chats(limit=100, offset=offset, unread_only=True)
-                items = (chats or {}).get("chats") or []
+                items = avito.list_chats(limit=100, offset=offset, unread_only=True)
+                listed_unread = bool(items)
+                if listed_unread:
+                    unread_ids.update(ch.id for ch in items if ch.id)
                 
                 # Если нет непрочитанных чатов, получаем все чаты для полной проверки
                 if not items and offset == 0:
                     logger.debug("Нет непрочитанных чатов, получаем все чаты")
-                    chats = avito.list_chats(limit=100, offset=offset, unread_only=False)
-                    items = (chats or {}).get("chats") or []
+                    items = avito.list_chats(limit=100, offset=offset, unread_only=False)
                 
                 if not items:
                     logger.debug("Больше чатов нет")
@@ -62,58 +77,91 @@ def run_polling_loop(
                 total_chats += len(items)
                 logger.info(f"Получено {len(items)} чатов (всего: {total_chats})")
 
+                # метаданные чатов берем из уже полученного списка — без доп. запросов
+                if chat_meta_cache:
+                    with db_session_factory() as db:
+                        chat_meta_cache.update_from_list(db, items)
+
                 for ch in items:
-                    chat_id = ch.get("id")
+                    chat_id = ch.id
                     if not chat_id:
                         continue
                         
                     logger.debug(f"Обработка чата {chat_id}")
                     chat_messages = 0
                     new_in_chat = 0
+                    caught_up = False  # дошли до уже известных сообщений или до начала чата
                     
                     # Получаем только последние сообщения (limit=50 вместо 100)
                     # и проверяем только первые несколько страниц
                     for page in range(3):  # максимум 3 страницы = 150 сообщений
                         moff = page * 50
                         logger.debug(f"Запрос сообщений чата {chat_id}: offset={moff}")
-                        msgs = avito.get_messages(chat_id, limit=50, offset=moff)
-                        arr = msgs if isinstance(msgs, list) else (msgs.get("messages") or [])
+                        arr = avito.get_messages(chat_id, limit=50, offset=moff)
                         if not arr:
                             logger.debug(f"Больше сообщений в чате {chat_id} нет")
+                            caught_up = True
                             break
                             
                         chat_messages += len(arr)
+                        if len(arr) < 50:
+                            caught_up = True
                         logger.debug(f"Получено {len(arr)} сообщений из чата {chat_id}")
                         
                         with db_session_factory() as db:
+                            fresh = []
                             for m in arr:
-                                mid = m.get("id")
+                                mid = m.id
                                 if not mid:
                                     continue
                                     
                                 if mid in seen:
                                     logger.debug(f"Сообщение {mid} уже обработано")
+                                    caught_up = True
                                     continue
                                     
                                 if persist_message(db, chat_id, m):
                                     seen.add(mid)
                                     new_messages += 1
                                     new_in_chat += 1
+                                    fresh.append(m)
                                     logger.info(f"Новое сообщение {mid} в чате {chat_id}")
-
-                                    def ask(text: str) -> str:
-                                        return ask_gpt_fn_factory()(text)
-                                    def maybe_reply(text: str):
-                                        if reply_avito:
-                                            avito.send_text(chat_id, text)
-
-                                    notify_and_optionally_ask_gpt(
-                                        db, telegram_bot_token, telegram_chat_id, chat_id, m, ask,
-                                        maybe_reply if reply_avito else None,
-                                        cutoff_dt=cutoff_dt,
-                                    )
                                 else:
+                                    caught_up = True
                                     logger.debug(f"Сообщение {mid} не было сохранено (дубликат)")
+
+                            # медиа всей страницы готовим разом: один запрос ссылок на голосовые,
+                            # параллельная загрузка файлов
+                            media = {}
+                            if media_pipeline and fresh:
+                                media = media_pipeline.prepare([m for m in fresh if should_notify(m, cutoff_dt)])
+
+                            if context_builder:
+                                # окно контекста в кэше пополняется по порядку времени
+                                for m in sorted(fresh, key=lambda m: (m.created or 0, m.id)):
+                                    context_builder.note_message(chat_id, m)
+
+                            def ask(text: str, msg_id=None) -> str:
+                                if context_builder:
+                                    text = context_builder.prompt(chat_id, text, msg_id)
+                                return ask_gpt_fn_factory()(text)
+                            def maybe_reply(text, source, image=None):
+                                if reply_avito:
+                                    send_reply(avito, outbound, chat_id, text, source, image)
+
+                            meta = None
+                            if chat_meta_cache and any(should_notify(m, cutoff_dt) for m in fresh):
+                                meta = chat_meta_cache.get(db, chat_id)
+
+                            for m in fresh:
+                                notify_and_optionally_ask_gpt(
+                                    db, telegram_bot_token, telegram_chat_id, chat_id, m, ask,
+                                    maybe_reply if reply_avito else None,
+                                    cutoff_dt=cutoff_dt,
+                                    media=media.get(m.id),
+                                    chat_meta=meta,
+                                    routing=routing,
+                                )
                         
                         # Если в этой странице не было новых сообщений, 
                         # скорее всего дальше тоже не будет
@@ -123,12 +171,27 @@ def run_polling_loop(
                     
                     if new_in_chat > 0:
                         logger.info(f"В чате {chat_id} найдено {new_in_chat} новых сообщений")
+
+                    # новые сообщения чата уже сохранены и отправлены — можно отметить прочитанным;
+                    # сама отметка откладывается до конца цикла, чтобы не сдвигать offset списка
+                    if read_marker and listed_unread and caught_up:
+                        read_marker.add(chat_id, ch.updated)
                     
                     total_messages += chat_messages
                         
                 offset += 100
 
             logger.info(f"Цикл завершен: чатов={total_chats}, сообщений={total_messages}, новых={new_messages}")
+
+            # список непрочитанных пролистан до конца — остальные чаты прочитаны на стороне Авито
+            if unread_complete:
+                with db_session_factory() as db:
+                    synced = sync_read_state(db, unread_ids, cycle_started)
+                if synced:
+                    logger.info(f"Отмечено прочитанными по данным Авито: {synced} сообщений")
+
+            if read_marker:
+                read_marker.flush()
             
             # Очищаем кэш seen каждые 100 циклов, чтобы не накапливать слишком много
             if cycle_count % 100 == 0:
@@ -169,14 +232,12 @@ def test_poller_once(avito: AvitoClient, db_session_factory, telegram_bot_token:
         while True:
             logger.info(f"Запрос чатов: offset={offset}")
             # Сначала пробуем получить только чаты с непрочитанными сообщениями
-            chats = avito.list_chats(limit=100, offset=offset, unread_only=True)
-            items = (chats or {}).get("chats") or []
+            items = avito.list_chats(limit=100, offset=offset, unread_only=True)
             
             # Если нет непрочитанных чатов, получаем все чаты для полной проверки
             if not items and offset == 0:
                 logger.info("Нет непрочитанных чатов, получаем все чаты")
-                chats = avito.list_chats(limit=100, offset=offset, unread_only=False)
-                items = (chats or {}).get("chats") or []
+                items = avito.list_chats(limit=100, offset=offset, unread_only=False)
             
             if not items:
                 logger.info("Больше чатов нет")
@@ -186,7 +247,7 @@ def test_poller_once(avito: AvitoClient, db_session_factory, telegram_bot_token:
             logger.info(f"Получено {len(items)} чатов (всего: {total_chats})")
 
             for ch in items:
-                chat_id = ch.get("id")
+                chat_id = ch.id
                 if not chat_id:
                     continue
                     
@@ -199,8 +260,7 @@ def test_poller_once(avito: AvitoClient, db_session_factory, telegram_bot_token:
                 for page in range(3):  # максимум 3 страницы = 150 сообщений
                     moff = page * 50
                     logger.info(f"Запрос сообщений чата {chat_id}: offset={moff}")
-                    msgs = avito.get_messages(chat_id, limit=50, offset=moff)
-                    arr = msgs if isinstance(msgs, list) else (msgs.get("messages") or [])
+                    arr = avito.get_messages(chat_id, limit=50, offset=moff)
                     if not arr:
                         logger.info(f"Больше сообщений в чате {chat_id} нет")
                         break
@@ -210,7 +270,7 @@ def test_poller_once(avito: AvitoClient, db_session_factory, telegram_bot_token:
                     
                     with db_session_factory() as db:
                         for m in arr:
-                            mid = m.get("id")
+                            mid = m.id
                             if not mid:
                                 continue
                                 
@@ -219,11 +279,11 @@ def test_poller_once(avito: AvitoClient, db_session_factory, telegram_bot_token:
                                 new_in_chat += 1
                                 logger.info(f"НОВОЕ сообщение {mid} в чате {chat_id}")
 
-                                def ask(text: str) -> str:
+                                def ask(text: str, msg_id=None) -> str:
                                     return ask_gpt_fn_factory()(text)
-                                def maybe_reply(text: str):
+                                def maybe_reply(text, source, image=None):
                                     if reply_avito:
-                                        avito.send_text(chat_id, text)
+                                        send_reply(avito, None, chat_id, text, source, image)
 
                                 notify_and_optionally_ask_gpt(
                                     db, telegram_bot_token, telegram_chat_id, chat_id, m, ask,
@@ -1,25 +1,55 @@
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterable, Optional
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 from datetime import datetime, timezone
-from .db import Chat, Message
-from .telegram_client import send_tg_message
+from .db import Chat, ChatStats, Message
+from .telegram_client import send_tg_message, send_tg_voice, send_tg_photo
+from .media import StoredMedia
+from .chat_meta import format_chat_meta
+from .models import AvitoMessage, Content
+from .routing import RoutingEngine
 
-GPT_TRIGGER = "для gpt"
 MAX_TG_LEN = 900  # ограничим размер текста в уведомлении
 
-def _get_text_from_content(content: Dict[str,Any]) -> Optional[str]:
+_default_routing = RoutingEngine()  # только правило "для gpt"
+
+def _get_text_from_content(content: Optional[Content]) -> Optional[str]:
     if not content:
         return None
-    if isinstance(content.get("text"), str):
-        return content["text"]
-    if isinstance(content.get("link"), dict):
-        t = content["link"].get("text")
-        if isinstance(t, str):
-            return t
+    if content.text is not None:
+        return content.text
+    if content.link is not None and content.link.text is not None:
+        return content.link.text
     return None
 
-def persist_message(db: Session, chat_id: str, msg: Dict[str,Any]) -> bool:
-    mid = msg.get("id")
+def _preview_text(content: Optional[Content]) -> str:
+    """Текст для уведомления; заглушки медиа только здесь — в messages.text их быть не должно."""
+    text = _get_text_from_content(content)
+    if text is not None:
+        return text
+    if content is not None and content.voice is not None:
+        return "<голосовое сообщение>"
+    if content is not None and content.image is not None:
+        return "<изображение>"
+    return "<нет текста>"
+
+def message_row(chat_id: str, msg: AvitoMessage) -> Dict[str,Any]:
+    """Поля строки messages для сообщения Авито (общие для ORM и COPY-загрузки)."""
+    created_dt = datetime.fromtimestamp(msg.created, tz=timezone.utc) if msg.created is not None else None
+    return {
+        "id": msg.id,
+        "chat_id": chat_id,
+        "author_id": msg.author_id,
+        "direction": msg.direction or "unknown",
+        "type": msg.type,
+        "text": _get_text_from_content(msg.content),
+        "created_ts": created_dt,
+        "is_read": msg.is_read,
+        "raw": msg.raw or None,
+    }
+
+def persist_message(db: Session, chat_id: str, msg: AvitoMessage) -> bool:
+    mid = msg.id
     if not mid:
         return False
     exists = db.get(Message, mid)
@@ -31,24 +61,47 @@ def persist_message(db: Session, chat_id: str, msg: Dict[str,Any]) -> bool:
         chat = Chat(id=chat_id)
         db.add(chat)
 
-    created = msg.get("created")
-    created_dt = datetime.fromtimestamp(created, tz=timezone.utc) if isinstance(created, (int,float)) else None
-    text = _get_text_from_content(msg.get("content") or {})
-    direction = msg.get("direction") or "unknown"
-
-    m = Message(
-        id=mid,
-        chat_id=chat_id,
-        author_id=msg.get("author_id"),
-        direction=direction,
-        type=msg.get("type"),
-        text=text,
-        created_ts=created_dt,
-        is_read=msg.get("is_read"),
-        raw=msg,
+    db.add(Message(**message_row(chat_id, msg)))
+    db.commit()
+    return True
+
+def sync_read_state(db: Session, unread_chat_ids: Iterable[str], before: datetime) -> int:
+    """
+    Отмечает прочитанными входящие сообщения чатов, которых нет в полном списке
+    unread_only от Авито (прочитаны в приложении Авито или через chat_read).
+    Вызывать только если список непрочитанных получен целиком; сообщения новее before
+    (начала цикла) не трогаем — их чата в списке могло еще не быть.
+    Триггеры на messages уменьшают chat_stats.unread_count.
+    """
+    res = db.execute(
+        update(Message)
+        .where(
+            Message.chat_id.in_(
+                select(ChatStats.chat_id).where(
+                    ChatStats.unread_count > 0, ChatStats.chat_id.not_in(list(unread_chat_ids))
+                )
+            ),
+            Message.direction == "in",
+            Message.is_read.is_not(True),
+            Message.created_ts < before,
+        )
+        .values(is_read=True)
+        .execution_options(synchronize_session=False)
     )
-    db.add(m)
     db.commit()
+    return res.rowcount
+
+def should_notify(msg: AvitoMessage, cutoff_dt: Optional[datetime]) -> bool:
+    # фильтр: только входящие
+    if (msg.direction or "").lower() != "in":
+        return False
+
+    # фильтр по свежести
+    if cutoff_dt is not None:
+        if msg.created is not None:
+            created_dt = datetime.fromtimestamp(msg.created, tz=timezone.utc)
+            if created_dt < cutoff_dt:
+                return False
     return True
 
 def notify_and_optionally_ask_gpt(
@@ -56,38 +109,58 @@ def notify_and_optionally_ask_gpt(
     bot_token: str,
     chat_id_tg: str,
     avito_chat_id: str,
-    msg: Dict[str,Any],
-    ask_gpt_fn,          # callable(text)->str
-    maybe_reply_avito,   # callable(text)->None or None
+    msg: AvitoMessage,
+    ask_gpt_fn,          # callable(text, msg_id)->str; msg_id — сообщение с вопросом
+    maybe_reply_avito,   # callable(text, source, image=None)->None or None; source — ключ идемпотентности
     cutoff_dt: Optional[datetime],  # порог свежести (UTC)
+    media: Optional[StoredMedia] = None,  # файл голосового/изображения, если скачан
+    chat_meta: Optional[Dict[str,Any]] = None,  # объявление/покупатель из ChatMetaCache
+    routing: Optional[RoutingEngine] = None,    # правила; по умолчанию только "для gpt"
 ):
-    # фильтр: только входящие
-    if (msg.get("direction") or "").lower() != "in":
+    if not should_notify(msg, cutoff_dt):
         return
 
-    # фильтр по свежести
-    if cutoff_dt is not None:
-        created = msg.get("created")
-        if isinstance(created, (int, float)):
-            created_dt = datetime.fromtimestamp(created, tz=timezone.utc)
-            if created_dt < cutoff_dt:
-                return
-
-    text = _get_text_from_content(msg.get("content") or {}) or "<нет текста>"
+    text = _get_text_from_content(msg.content) or ""
     preview = (f"Новое сообщение в Авито\n"
                f"Чат: {avito_chat_id}\n"
-               f"Тип: {msg.get('type')}  Направление: {msg.get('direction')}\n"
-               f"Текст: {text[:MAX_TG_LEN]}")
+               f"{format_chat_meta(chat_meta)}"
+               f"Тип: {msg.type}  Направление: {msg.direction}\n"
+               f"Текст: {_preview_text(msg.content)[:MAX_TG_LEN]}")
     try:
         send_tg_message(bot_token, chat_id_tg, preview)
     except Exception:
         pass
 
-    lower = (text or "").lower()
-    if GPT_TRIGGER in lower:
-        q = lower.replace(GPT_TRIGGER, "").strip() or text
+    if media is not None:
+        send_file = send_tg_voice if media.kind == "voice" else send_tg_photo
+        try:
+            send_file(bot_token, chat_id_tg, media.path, caption=f"Чат: {avito_chat_id}")
+        except Exception:
+            pass
+
+    route = (routing or _default_routing).route(text, (chat_meta or {}).get("item_id"))
+    if route.stopped_by:
+        try:
+            send_tg_message(bot_token, chat_id_tg, f"Стоп-правило «{route.stopped_by}»: автоответы отключены")
+        except Exception:
+            pass
+        return
+
+    for rule in route.replies:
+        try:
+            note = rule.reply or f"<изображение {rule.image}>"
+            send_tg_message(bot_token, chat_id_tg, f"Автоответ:\n{note[:MAX_TG_LEN]}")
+        except Exception:
+            pass
+        if maybe_reply_avito:
+            try:
+                maybe_reply_avito(rule.reply, f"{msg.id}:rule:{rule.name}", image=rule.image)
+            except Exception:
+                pass
+
+    if route.gpt_question is not None:
         try:
-            answer = ask_gpt_fn(q)
+            answer = ask_gpt_fn(route.gpt_question, msg.id)
         except Exception as e:
             answer = f"Ошибка запроса к GPT: {type(e).__name__}: {e}"
         try:
@@ -96,6 +169,6 @@ def notify_and_optionally_ask_gpt(
             pass
         if maybe_reply_avito:
             try:
-                maybe_reply_avito(answer)
+                maybe_reply_avito(answer, f"{msg.id}:gpt")
             except Exception:
                 pass
@@ -0,0 +1,119 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import update
+from .avito_client import AvitoClient, RateLimiter, MAX_OFFSET, MAX_PAGE_SIZE
+from .db import Message
+
+logger = logging.getLogger(__name__)
+
+
+class ReadMarker:
+    """
+    Отложенная отметка чатов прочитанными.
+
+    Поллер добавляет чат вместе с его ChatItem.updated, когда все новые сообщения чата
+    сохранены и отправлены в Telegram; в конце цикла накопленные чаты отмечаются через
+    chat_read пачкой (не больше batch_size за цикл, с собственным лимитом rps). Остаток и
+    неудачные чаты переходят в следующий цикл.
+    Отмечать сразу нельзя: чат пропал бы из списка unread_only, который еще листается по offset.
+    Перед отметкой список unread_only запрашивается заново: чат, у которого updated
+    изменился после сканирования (пришло новое сообщение), не отмечается — поллер
+    обработает его в следующем цикле и добавит снова.
+    """
+
+    def __init__(self, avito: AvitoClient, session_factory, rps: float = 2.0, batch_size: int = 100, workers: int = 4):
+        self.avito = avito
+        self.session_factory = session_factory
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self._limiter = RateLimiter(rps)
+        self._pending: Dict[str, int] = {}  # chat_id -> updated на момент сканирования
+        self._lock = threading.Lock()
+        self._marked = 0
+        self._failed = 0
+
+    def add(self, chat_id: str, updated: Optional[int]):
+        if updated is None:
+            return  # без updated нельзя проверить, что чат не изменился — не отмечаем
+        with self._lock:
+            self._pending[chat_id] = updated
+
+    def _current_unread(self) -> Tuple[Dict[str, Optional[int]], bool]:
+        """updated непрочитанных чатов по данным Авито; второй элемент — список получен целиком."""
+        current: Dict[str, Optional[int]] = {}
+        offset = 0
+        while offset <= MAX_OFFSET:
+            items = self.avito.list_chats(limit=MAX_PAGE_SIZE, offset=offset, unread_only=True)
+            current.update((ch.id, ch.updated) for ch in items if ch.id)
+            if len(items) < MAX_PAGE_SIZE:
+                return current, True
+            offset += MAX_PAGE_SIZE
+        return current, False
+
+    def _read(self, chat_id: str) -> bool:
+        self._limiter.wait()
+        try:
+            self.avito.chat_read(chat_id)
+            return True
+        except Exception as e:
+            logger.warning(f"Не удалось отметить чат {chat_id} прочитанным: {type(e).__name__}: {e}")
+            return False
+
+    def flush(self) -> int:
+        """Отмечает накопленные чаты; возвращает, сколько отмечено."""
+        with self._lock:
+            if not self._pending:
+                return 0
+            scanned = dict(self._pending)
+
+        current, complete = self._current_unread()
+        batch: List[str] = []
+        stale: List[str] = []
+        for chat_id, updated in scanned.items():
+            if chat_id in current:
+                if current[chat_id] == updated:
+                    batch.append(chat_id)
+                else:
+                    stale.append(chat_id)  # после сканирования пришли сообщения
+            elif complete:
+                stale.append(chat_id)  # уже прочитан
+        with self._lock:
+            for chat_id in stale:
+                if self._pending.get(chat_id) == scanned[chat_id]:
+                    self._pending.pop(chat_id, None)
+        batch = batch[:self.batch_size]
+        if not batch:
+            return 0
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(batch)), thread_name_prefix="chat-read") as pool:
+            ok = list(pool.map(self._read, batch))
+        done = [chat_id for chat_id, res in zip(batch, ok) if res]
+        with self._lock:
+            for chat_id in done:
+                if self._pending.get(chat_id) == scanned[chat_id]:
+                    self._pending.pop(chat_id, None)
+            self._marked += len(done)
+            self._failed += len(batch) - len(done)
+
+        if done:
+            # локально тоже отмечаем входящие прочитанными (не новее проверенного updated) —
+            # триггеры обновят chat_stats.unread_count
+            with self.session_factory() as db:
+                for chat_id in done:
+                    db.execute(
+                        update(Message)
+                        .where(
+                            Message.chat_id == chat_id, Message.direction == "in", Message.is_read.is_not(True),
+                            Message.created_ts <= datetime.fromtimestamp(scanned[chat_id], tz=timezone.utc),
+                        )
+                        .values(is_read=True)
+                    )
+                db.commit()
+        logger.info(f"Отмечено прочитанными чатов: {len(done)} из {len(batch)}, в очереди {len(self._pending)}")
+        return len(done)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"pending": len(self._pending), "marked": self._marked, "failed": self._failed}
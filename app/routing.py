@@ -0,0 +1,333 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ("gpt", "reply", "stop")
+
+GPT_TRIGGER = "для gpt"
+
+# Правило по умолчанию — прежнее поведение: "для gpt" в тексте отправляет вопрос в GPT
+DEFAULT_RULES: List[Dict[str, Any]] = [
+    {"name": "gpt", "action": "gpt", "keywords": [GPT_TRIGGER]},
+]
+
+
+@dataclass
+class Rule:
+    """
+    name     — имя для счетчиков и логов
+    action   — gpt | reply | stop (stop отменяет gpt/reply для сообщения)
+    keywords — подстроки (без учета регистра); regex — регулярное выражение (без учета регистра)
+    item_ids — правило действует только для чатов по этим объявлениям
+    reply    — текст автоответа; image — путь к изображению, отправляемому вместе с ним
+    Правило без keywords и regex срабатывает на каждое сообщение (с учетом item_ids).
+    """
+    name: str
+    action: str
+    keywords: List[str] = field(default_factory=list)
+    regex: Optional[str] = None
+    item_ids: Optional[List[int]] = None
+    reply: Optional[str] = None
+    image: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Rule":
+        rule = cls(
+            name=str(d["name"]),
+            action=d["action"],
+            keywords=[k.lower() for k in d.get("keywords") or [] if k],
+            regex=d.get("regex") or None,
+            item_ids=[int(i) for i in d["item_ids"]] if d.get("item_ids") else None,
+            reply=d.get("reply"),
+            image=d.get("image") or None,
+        )
+        if rule.action not in ACTIONS:
+            raise ValueError(f"правило {rule.name}: неизвестное действие {rule.action}")
+        if rule.action == "reply" and not (rule.reply or rule.image):
+            raise ValueError(f"правило {rule.name}: для reply нужен текст ответа или изображение")
+        return rule
+
+
+@dataclass
+class RouteResult:
+    matched: List[str] = field(default_factory=list)
+    gpt_question: Optional[str] = None
+    replies: List[Rule] = field(default_factory=list)  # сработавшие reply-правила по порядку
+    stopped_by: Optional[str] = None
+
+
+class AhoCorasick:
+    """Автомат Ахо–Корасик: все вхождения всех ключевых слов за один проход по тексту."""
+
+    def __init__(self, words: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for idx, word in enumerate(words):
+            node = 0
+            for ch in word:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(idx)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str) -> Iterator[int]:
+        """Индексы найденных слов (слово может встретиться несколько раз)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                yield from out[node]
+
+
+try:  # разбор выражений для извлечения литералов; без него все regex проверяются напрямую
+    from re import _parser as _sre_parse
+    from re import _casefix
+except ImportError:  # pragma: no cover
+    _sre_parse = None
+    _casefix = None
+
+# Приведение регистра, согласованное с re.IGNORECASE: символы, которые re считает равными
+# (в том числе "лишние" пары вроде в/ᲀ, s/ſ), отображаются в один представитель.
+_PRE_LOWER = {0x130: "i"}  # İ: str.lower дает два символа, re сравнивает с i
+_CASE_CANON: Dict[int, str] = {}
+if _casefix is not None:
+    for _lo, _extra in _casefix._EXTRA_CASES.items():
+        _group = (_lo, *_extra)
+        for _c in _group:
+            _CASE_CANON[_c] = chr(min(_group))
+
+
+def _fold(text: str) -> str:
+    return text.translate(_PRE_LOWER).lower().translate(_CASE_CANON)
+
+
+def _literal_score(lits: frozenset) -> tuple:
+    return (min(len(s) for s in lits), -len(lits))
+
+
+def _required_literals(seq) -> Optional[frozenset]:
+    """
+    Набор литералов, хотя бы один из которых обязательно входит в любое совпадение
+    (None — такого набора нет). Из нескольких вариантов выбирается самый избирательный.
+    """
+    best: Optional[frozenset] = None
+    run: List[str] = []
+
+    def consider(lits: Optional[frozenset]):
+        nonlocal best
+        if lits and all(lits) and (best is None or _literal_score(lits) > _literal_score(best)):
+            best = lits
+
+    def flush():
+        if run:
+            consider(frozenset(["".join(run)]))
+            run.clear()
+
+    for op, av in seq:
+        if op == _sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        flush()
+        if op == _sre_parse.SUBPATTERN:
+            consider(_required_literals(av[-1]))
+        elif op == _sre_parse.ATOMIC_GROUP:
+            consider(_required_literals(av))
+        elif op in (_sre_parse.MAX_REPEAT, _sre_parse.MIN_REPEAT, _sre_parse.POSSESSIVE_REPEAT) and av[0] >= 1:
+            consider(_required_literals(av[2]))
+        elif op == _sre_parse.BRANCH:
+            alts = [_required_literals(alt) for alt in av[1]]
+            if all(alts):
+                consider(frozenset().union(*alts))
+        elif op == _sre_parse.ASSERT:
+            consider(_required_literals(av[1]))
+    flush()
+    return best
+
+
+def regex_literals(pattern: str) -> Optional[frozenset]:
+    """Обязательные литералы выражения в приведенном регистре (см. _fold) или None."""
+    if _sre_parse is None:
+        return None
+    try:
+        lits = _required_literals(_sre_parse.parse(pattern, re.IGNORECASE))
+    except Exception:
+        return None
+    if not lits:
+        return None
+    lits = frozenset(_fold(s) for s in lits)
+    return lits if all(lits) else None
+
+
+class CompiledRules:
+    """
+    Набор правил, собранный в один автомат Ахо–Корасик.
+
+    В автомат входят ключевые слова и обязательные литералы регулярных выражений
+    (например, для "доставк[аи]\\s+(в|до)" — "доставк"). Текст проходится автоматом
+    один раз; регулярное выражение запускается только у правил, чей литерал нашелся.
+    Выражения без обязательного литерала (вроде "\\d{5,}") проверяются на каждом
+    сообщении — о них пишется предупреждение при загрузке.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        words: List[str] = []
+        self._word_rules: List[List[int]] = []   # правила с этим ключевым словом — сработали
+        self._word_regex: List[List[int]] = []   # regex-правила с этим литералом — кандидаты
+        word_index: Dict[str, int] = {}
+
+        def word(w: str) -> int:
+            wi = word_index.setdefault(w, len(words))
+            if wi == len(words):
+                words.append(w)
+                self._word_rules.append([])
+                self._word_regex.append([])
+            return wi
+
+        self._regexes: Dict[int, re.Pattern] = {}
+        self._unfiltered: List[int] = []
+        for ri, rule in enumerate(rules):
+            for kw in rule.keywords:
+                self._word_rules[word(_fold(kw))].append(ri)
+            if not rule.regex:
+                continue
+            self._regexes[ri] = re.compile(rule.regex, re.IGNORECASE)  # ошибка в выражении отклоняет весь файл
+            lits = regex_literals(rule.regex)
+            if lits is None:
+                logger.warning(f"Правило {rule.name}: в regex нет обязательного литерала, проверяется на каждом сообщении")
+                self._unfiltered.append(ri)
+                continue
+            for lit in lits:
+                self._word_regex[word(lit)].append(ri)
+        self._automaton = AhoCorasick(words) if words else None
+        self._always = [ri for ri, r in enumerate(rules) if not r.keywords and not r.regex]
+
+    def _scan(self, text: str) -> tuple[set, set]:
+        hit: set = set(self._always)
+        candidates: set = set(self._unfiltered)
+        if self._automaton is not None:
+            for wi in self._automaton.iter_matches(_fold(text)):
+                hit.update(self._word_rules[wi])
+                candidates.update(self._word_regex[wi])
+        return hit, candidates
+
+    def candidates(self, text: str) -> List[int]:
+        """Regex-правила, выражения которых придется выполнить для этого текста."""
+        return sorted(self._scan(text)[1])
+
+    def match(self, text: str) -> List[int]:
+        """Индексы сработавших правил в порядке их объявления."""
+        hit, candidates = self._scan(text)
+        for ri in candidates:
+            if ri not in hit and self._regexes[ri].search(text):
+                hit.add(ri)
+        return sorted(hit)
+
+
+class RoutingEngine:
+    """
+    Правила маршрутизации входящих сообщений. Загружаются из JSON-файла (список правил)
+    и перечитываются без перезапуска: файл проверяется не чаще раза в reload_sec секунд
+    и пересобирается при изменении mtime. Если файл не задан — DEFAULT_RULES.
+    """
+
+    def __init__(self, path: str = "", reload_sec: float = 5.0):
+        self.path = path
+        self.reload_sec = reload_sec
+        self._lock = threading.Lock()
+        self._hits: Counter[str] = Counter()
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._compiled = CompiledRules([Rule.from_dict(d) for d in DEFAULT_RULES])
+        if path:
+            self.reload()
+
+    def reload(self) -> bool:
+        """Перечитывает файл правил; при ошибке оставляет прежний набор."""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding="utf-8") as f:
+                compiled = CompiledRules([Rule.from_dict(d) for d in json.load(f)])
+        except Exception as e:
+            logger.error(f"Не удалось загрузить правила из {self.path}: {type(e).__name__}: {e}")
+            return False
+        with self._lock:
+            self._compiled = compiled
+            self._mtime = mtime
+        logger.info(f"Загружено правил маршрутизации: {len(compiled.rules)}")
+        return True
+
+    def _maybe_reload(self):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_sec:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def route(self, text: str, item_id: Optional[int] = None) -> RouteResult:
+        self._maybe_reload()
+        compiled = self._compiled
+        result = RouteResult()
+        rules = [
+            compiled.rules[ri] for ri in compiled.match(text)
+            if compiled.rules[ri].item_ids is None or item_id in compiled.rules[ri].item_ids
+        ]
+        with self._lock:
+            self._hits.update(r.name for r in rules)
+        result.matched = [r.name for r in rules]
+
+        stop = next((r for r in rules if r.action == "stop"), None)
+        if stop is not None:
+            result.stopped_by = stop.name
+            return result
+        for r in rules:
+            if r.action == "gpt" and result.gpt_question is None:
+                q = text.lower()
+                for kw in r.keywords:
+                    q = q.replace(kw, "")
+                result.gpt_question = q.strip() or text
+            elif r.action == "reply":
+                result.replies.append(r)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rules": [r.name for r in self._compiled.rules],
+                "hits": dict(self._hits),
+            }
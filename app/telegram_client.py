@@ -10,3 +10,20 @@ def send_tg_message(bot_token: str, chat_id: str, text: str, disable_preview: bo
     r = _session.post(url, data=data, timeout=15, proxies=_NOPX)
     r.raise_for_status()
     return r.json()
+
+def _send_tg_file(method: str, field: str, bot_token: str, chat_id: str, path: str, caption: str | None = None):
+    url = f"https://api.telegram.org/bot{bot_token}/{method}"
+    data = {"chat_id": chat_id}
+    if caption:
+        data["caption"] = caption
+    # файл передается открытым объектом — requests отправляет его потоково, не читая целиком
+    with open(path, "rb") as f:
+        r = _session.post(url, data=data, files={field: f}, timeout=60, proxies=_NOPX)
+    r.raise_for_status()
+    return r.json()
+
+def send_tg_voice(bot_token: str, chat_id: str, path: str, caption: str | None = None):
+    return _send_tg_file("sendVoice", "voice", bot_token, chat_id, path, caption)
+
+def send_tg_photo(bot_token: str, chat_id: str, path: str, caption: str | None = None):
+    return _send_tg_file("sendPhoto", "photo", bot_token, chat_id, path, caption)
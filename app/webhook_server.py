@@ -1,20 +1,46 @@
-from fastapi import FastAPI, Request, BackgroundTasks
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Request
 from sqlalchemy.orm import Session
 from datetime import datetime, timezone, timedelta
 from .config import Settings
-from .db import make_engine, make_session_factory, Base
+from .db import make_engine, make_session_factory, ensure_schema
 from .avito_client import AvitoClient
-from .ai_client import make_openai_client, ask_gpt
-from .processor import persist_message, notify_and_optionally_ask_gpt
+from .ai_client import make_openai_client, ask_gpt_once
+from .processor import persist_message, notify_and_optionally_ask_gpt, should_notify
+from .media import MediaStore, MediaPipeline
+from .chat_meta import ChatMetaCache
+from .api import router as api_router
+from .models import decode_webhook
+from .routing import RoutingEngine
+from .llm_governor import LLMGovernor, PRIORITY_BACKGROUND
+from .gpt_context import ContextBuilder
+from .outbound import OutboundQueue, send_reply
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Avito Webhook Bridge")
 
 settings = Settings()
 engine = make_engine(settings.db_url, echo=settings.db_echo)
-Base.metadata.create_all(engine)
+ensure_schema(engine)
 SessionFactory = make_session_factory(engine)
+app.state.session_factory = SessionFactory
+app.state.api_token = settings.api_token
+app.include_router(api_router)
+
+avito = AvitoClient(settings.avito_client_id, settings.avito_client_secret, settings.avito_user_id, rps=settings.avito_rps)
 
-avito = AvitoClient(settings.avito_client_id, settings.avito_client_secret, settings.avito_user_id)
+routing_engine = RoutingEngine(settings.routing_rules_path, settings.routing_reload_sec)
+app.state.routing = routing_engine
+
+chat_meta_cache = ChatMetaCache(avito, settings.chat_meta_ttl_sec, settings.chat_meta_cache_size)
+
+media_pipeline = None
+if settings.media_enabled:
+    media_pipeline = MediaPipeline(
+        avito, MediaStore(settings.media_dir, settings.media_max_mb * 1024 * 1024), settings.media_workers
+    )
 
 oai_client = None
 if settings.openai_api_key:
@@ -22,51 +48,86 @@ if settings.openai_api_key:
         api_key=settings.openai_api_key,
     )
 
+# один на процесс: через него ходят и вебхук, и поллер (main.py)
+llm_governor = LLMGovernor(
+    ask_gpt_once,
+    max_concurrency=settings.llm_max_concurrency,
+    tokens_per_minute=settings.llm_tokens_per_minute,
+    max_retries=settings.llm_max_retries,
+)
+app.state.llm = llm_governor
+
+# ответы в Авито уходят через очередь: по порядку внутри чата, без повторной отправки
+outbound_queue = None
+if settings.reply_back_to_avito:
+    outbound_queue = OutboundQueue(
+        avito, SessionFactory, workers=settings.outbound_workers, max_attempts=settings.outbound_max_attempts
+    )
+    outbound_queue.start()
+app.state.outbound = outbound_queue
+
+context_builder = None
+if settings.gpt_context_enabled and settings.openai_api_key:
+    context_builder = ContextBuilder(
+        SessionFactory,
+        summarize_fn=lambda prompt: llm_governor.ask(prompt, priority=PRIORITY_BACKGROUND),
+        token_budget=settings.gpt_context_token_budget,
+        max_turns=settings.gpt_context_max_turns,
+        summary_max_chars=settings.gpt_summary_max_chars,
+    )
+
+# уведомления и вопросы к GPT из вебхука выполняются здесь, а не в BackgroundTasks:
+# ожидание в очереди LLMGovernor не должно занимать потоки Starlette, общие с /api
+webhook_executor = ThreadPoolExecutor(max_workers=max(1, settings.webhook_workers), thread_name_prefix="webhook")
+
 @app.post("/avito/webhook")
-async def avito_webhook(request: Request, bg: BackgroundTasks):
+async def avito_webhook(request: Request):
+    # тело разбирается один раз прямо из байтов в типизированную запись
     try:
-        payload = await request.json()
+        decoded = decode_webhook(await request.body(), settings.avito_user_id)
     except Exception:
         return {"ok": True}
-
-    # Avito иногда заворачивает в { payload: { type: 'message', value: {...} } }
-    inner = payload.get("payload") if isinstance(payload, dict) else None
-    value = inner.get("value") if isinstance(inner, dict) else (payload if isinstance(payload, dict) else {})
-    if not isinstance(value, dict):
+    if decoded is None:
         return {"ok": True}
+    chat_id, msg = decoded
 
     db: Session = SessionFactory()
     try:
-        chat_id = value.get("chat_id")
-        if not chat_id:
-            return {"ok": True}
-
-        changed = persist_message(db, chat_id, {
-            "id": value.get("id"),
-            "author_id": value.get("author_id"),
-            "direction": "in",
-            "type": value.get("type"),
-            "content": value.get("content"),
-            "created": value.get("created"),
-            "is_read": False
-        })
-
-        def ask(text: str) -> str:
+        changed = persist_message(db, chat_id, msg)
+
+        def ask(text: str, msg_id=None) -> str:
             if oai_client:
-                return ask_gpt(text)
+                if context_builder:
+                    text = context_builder.prompt(chat_id, text, msg_id)
+                return llm_governor.ask(text)
             return "GPT is not configured"
 
-        def reply_avito(answer: str):
+        def reply_avito(answer, source, image=None):
             if settings.reply_back_to_avito:
-                avito.send_text(chat_id, answer)
+                send_reply(avito, outbound_queue, chat_id, answer, source, image)
+
+        def notify(cutoff_dt: datetime):
+            try:
+                with SessionFactory() as task_db:
+                    media = meta = None
+                    if should_notify(msg, cutoff_dt):
+                        # медиа и метаданные нужны только для уведомления — как в поллере
+                        if media_pipeline:
+                            media = media_pipeline.prepare([msg]).get(msg.id)
+                        meta = chat_meta_cache.get(task_db, chat_id)
+                    notify_and_optionally_ask_gpt(
+                        task_db, settings.telegram_bot_token, settings.telegram_chat_id, chat_id, msg,
+                        ask, reply_avito if settings.reply_back_to_avito else None, cutoff_dt,
+                        media=media, chat_meta=meta, routing=routing_engine,
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка обработки вебхука для чата {chat_id}: {type(e).__name__}: {e}", exc_info=True)
 
         if changed:
+            if context_builder:
+                context_builder.note_message(chat_id, msg)
             cutoff_dt = datetime.now(tz=timezone.utc) - timedelta(minutes=max(1, settings.poll_only_since_minutes))
-            bg.add_task(
-                notify_and_optionally_ask_gpt,
-                db, settings.telegram_bot_token, settings.telegram_chat_id, chat_id, value,
-                ask, reply_avito if settings.reply_back_to_avito else None, cutoff_dt
-            )
+            webhook_executor.submit(notify, cutoff_dt)
     finally:
         db.close()
 
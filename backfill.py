@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Загрузка полной истории сообщений Авито в БД (можно перезапускать — продолжит с чекпоинтов)
+"""
+from dotenv import load_dotenv, find_dotenv
+load_dotenv(find_dotenv(), override=True)
+
+import logging
+from app.config import Settings
+from app.db import make_engine, make_session_factory, ensure_schema
+from app.avito_client import AvitoClient
+from app.backfill import run_backfill
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def main():
+    cfg = Settings()
+    logger.info(f"Backfill: потоков={cfg.backfill_workers}, лимит={cfg.backfill_rps} rps, страница={cfg.backfill_page_size}")
+
+    engine = make_engine(cfg.db_url, echo=cfg.db_echo)
+    ensure_schema(engine)
+    SessionFactory = make_session_factory(engine)
+    avito = AvitoClient(cfg.avito_client_id, cfg.avito_client_secret, cfg.avito_user_id, rps=cfg.backfill_rps)
+
+    progress = run_backfill(
+        avito=avito,
+        engine=engine,
+        db_session_factory=SessionFactory,
+        workers=cfg.backfill_workers,
+        page_size=cfg.backfill_page_size,
+        live_window_minutes=cfg.poll_only_since_minutes,
+    )
+    if progress.failed_chats:
+        logger.warning(f"Не загружено чатов: {progress.failed_chats}, запустите скрипт повторно")
+    if progress.truncated_chats:
+        logger.warning(f"Чатов, история которых обрезана лимитом offset API: {progress.truncated_chats}")
+
+if __name__ == "__main__":
+    main()
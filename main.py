@@ -5,14 +5,17 @@ load_dotenv(find_dotenv(), override=True)
 from threading import Thread
 import uvicorn
 from app.config import Settings
-from app.db import make_engine, make_session_factory, Base
-from app.avito_client import AvitoClient
-from app.webhook_server import app
+from app.db import make_engine, make_session_factory, ensure_schema
+# клиент Авито (с его лимитом AVITO_RPS) и медиа-пайплайн общие с вебхуком
+from app.webhook_server import (
+    app, avito, media_pipeline, routing_engine, llm_governor, context_builder, outbound_queue, chat_meta_cache,
+)
 from app.ai_client import make_openai_client
 from app.poller import run_polling_loop
 import requests
 from app.ai_client import make_openai_client, probe_openai
 from app.telegram_client import send_tg_message
+from app.read_marker import ReadMarker
 
 if __name__ == "__main__":
     cfg = Settings()
@@ -27,9 +30,11 @@ if __name__ == "__main__":
 
     # Подготовка сервисов для поллинга
     engine = make_engine(cfg.db_url, echo=cfg.db_echo)
-    Base.metadata.create_all(engine)
+    ensure_schema(engine)
     SessionFactory = make_session_factory(engine)
-    avito = AvitoClient(cfg.avito_client_id, cfg.avito_client_secret, cfg.avito_user_id)
+    read_marker = None
+    if cfg.mark_read_enabled:
+        read_marker = ReadMarker(avito, SessionFactory, rps=cfg.mark_read_rps, batch_size=cfg.mark_read_batch)
 
     oai = None
     if cfg.openai_api_key:
@@ -41,8 +46,7 @@ if __name__ == "__main__":
 
     def ask_factory():
         if oai:
-            from app.ai_client import ask_gpt
-            return lambda text: ask_gpt(text)
+            return lambda text: llm_governor.ask(text)
         return lambda text: "GPT is not configured"
 
     # Главный поток — поллинг
@@ -55,4 +59,10 @@ if __name__ == "__main__":
         ask_gpt_fn_factory=ask_factory,
         reply_avito=cfg.reply_back_to_avito,
         only_since_minutes=cfg.poll_only_since_minutes,
+        media_pipeline=media_pipeline,
+        chat_meta_cache=chat_meta_cache,  # общий с вебхуком: данные из list_chats видны обоим
+        routing=routing_engine,  # общий с вебхуком: одни правила и одни счетчики
+        context_builder=context_builder,
+        outbound=outbound_queue,  # общая с вебхуком: порядок ответов в чате не зависит от источника
+        read_marker=read_marker,
     )
@@ -7,7 +7,7 @@ load_dotenv(find_dotenv(), override=True)
 
 import logging
 from app.config import Settings
-from app.db import make_engine, make_session_factory, Base
+from app.db import make_engine, make_session_factory, ensure_schema
 from app.avito_client import AvitoClient
 from app.ai_client import make_openai_client
 from app.poller import test_poller_once
@@ -25,7 +25,7 @@ def main():
     
     # Инициализация БД
     engine = make_engine(cfg.db_url, echo=cfg.db_echo)
-    Base.metadata.create_all(engine)
+    ensure_schema(engine)
     SessionFactory = make_session_factory(engine)
     logger.info("База данных инициализирована")
     
@@ -0,0 +1,99 @@
+from app.routing import AhoCorasick, CompiledRules, Rule, RoutingEngine
+
+
+def _rules(*dicts):
+    return CompiledRules([Rule.from_dict(d) for d in dicts])
+
+
+def test_aho_corasick_finds_overlapping_words():
+    ac = AhoCorasick(["he", "she", "his", "hers"])
+    assert sorted(set(ac.iter_matches("ushers"))) == [0, 1, 3]
+    assert list(ac.iter_matches("xyz")) == []
+
+
+def test_keywords_are_case_insensitive():
+    compiled = _rules({"name": "price", "action": "gpt", "keywords": ["Цена"]})
+    assert compiled.match("Какая ЦЕНА?") == [0]
+    assert compiled.match("привет") == []
+
+
+def test_overlapping_regex_rules_all_match():
+    compiled = _rules(
+        {"name": "a", "action": "gpt", "regex": "доставк\\w+"},
+        {"name": "b", "action": "stop", "regex": "доставка"},
+    )
+    assert compiled.match("есть доставка?") == [0, 1]
+
+
+def test_backreference_rule_after_another_regex_rule():
+    compiled = _rules(
+        {"name": "other", "action": "gpt", "regex": "(x)y"},
+        {"name": "double", "action": "gpt", "regex": "(a)\\1"},
+    )
+    assert compiled.match("aa") == [1]
+    assert compiled.match("xy") == [0]
+
+
+def test_named_groups_and_inline_flags_do_not_break_the_set():
+    compiled = _rules(
+        {"name": "n1", "action": "gpt", "regex": "(?P<num>\\d+) шт"},
+        {"name": "n2", "action": "gpt", "regex": "(?P<num>\\d+) руб"},
+        {"name": "flags", "action": "gpt", "regex": "(?s)a.b"},
+    )
+    assert compiled.match("5 шт за 100 руб") == [0, 1]
+    assert compiled.match("a\nb") == [2]
+
+
+def test_rule_without_patterns_always_matches_and_item_filter():
+    engine = RoutingEngine()
+    engine._compiled = _rules(
+        {"name": "all", "action": "reply", "reply": "Спасибо!", "item_ids": [42]},
+    )
+    assert engine.route("что угодно", item_id=42).matched == ["all"]
+    assert engine.route("что угодно", item_id=7).matched == []
+
+
+def test_default_rule_extracts_gpt_question():
+    result = RoutingEngine().route("Для GPT сколько стоит доставка?")
+    assert result.gpt_question == "сколько стоит доставка?"
+
+
+class _CountingPattern:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.calls = 0
+
+    def search(self, text):
+        self.calls += 1
+        return self.pattern.search(text)
+
+
+def _regex_work(n_rules: int, text: str) -> int:
+    compiled = _rules(*(
+        {"name": f"r{i}", "action": "gpt", "regex": f"товар{i:04d}\\s+(есть|нет)"} for i in range(n_rules)
+    ))
+    counters = {ri: _CountingPattern(p) for ri, p in compiled._regexes.items()}
+    compiled._regexes = counters
+    compiled.match(text)
+    return sum(c.calls for c in counters.values())
+
+
+def test_regex_work_does_not_grow_with_rule_count():
+    text = "Здравствуйте, актуально ли объявление? Можно посмотреть сегодня? " * 16
+    assert _regex_work(10, text) == 0
+    assert _regex_work(1000, text) == 0
+    # выполняется только выражение правила, чей литерал встретился в тексте
+    assert _regex_work(1000, text + " товар0500 есть") == 1
+
+
+def test_regex_literals_prefilter():
+    from app.routing import regex_literals
+    assert regex_literals("доставк[аи]\\s+(в|до)") == {"доставк"}
+    assert regex_literals("(цена|стоимост\\w*)") == {"цена", "стоимост"}
+    assert regex_literals("\\d{5,}") is None
+
+
+def test_prefilter_follows_regex_case_folding():
+    compiled = _rules({"name": "city", "action": "gpt", "regex": "istanbul|привет"})
+    assert compiled.match("İSTANBUL") == [0]
+    assert compiled.match("ПРИВЕТ") == [0]